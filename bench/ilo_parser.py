@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compares ilo_parser with the way SSHiLoSensors used to handle the output of the iLo (as in the code before it:
+escaping characters with a generator and re.findall of the properties after each `show`, one per component),
+checking that both give the same results. Runs against the recorded samples: doc/ilo_show_output.txt (`show`
+of a sensor), doc/sensors.txt (no targets at all), `show /system1` with all the components named there
+and a poll of them: a `show` of every one before, a single listing of /system1 (like `show -l 2 /system1`) now.
+The ones with sensors also with a non-printable character in every sensor.
+
+usage: bench/ilo_parser.py [repeat]"""
+
+import os
+import re
+import string
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import ilo_parser
+
+def old_sanitize(output):
+    return ''.join(ch if ch in string.printable else "\\0x%02X"%ord(ch) for ch in output)
+
+def old_show(output):
+    return dict(re.findall("    (\w+)=([^\r]+)", output))
+
+def old_parse(outputs):
+    """Parses outputs of `show`, each one as [path, output], /system1 first"""
+    blocks = dict((path, old_show(output)) for path, output in outputs)
+    system = outputs[0][1] if outputs[0][0] == '/system1' else ''
+    children = sorted(set("/system1/{0}".format(a) for a in re.findall("    (sensor\d)", system)) |
+                      set("/system1/{0}".format(a) for a in re.findall("    (powersupply\d)", system)))
+    return dict((path, block) for path, block in blocks.iteritems() if block), children
+
+CHILD = re.compile("(sensor|powersupply)\d+$")
+
+def new_parse(output):
+    status, targets = ilo_parser.parse(output)
+    blocks = dict((path, target.properties) for path, target in targets.iteritems() if target.properties)
+    system = targets['/system1'].targets if '/system1' in targets else []
+    children = sorted(set("/system1/{0}".format(name) for name in system if CHILD.match(name)))
+    return blocks, children
+
+def shows(sample, notes):
+    """Makes the outputs of `show` of /system1 and of every component in the notes, each one like the sample"""
+    header, _, block = sample.partition('/system1/sensor3')
+    paths = sorted(set(re.findall("show (/system1\S*)", notes)))
+    children = [path.split('/')[-1] for path in paths if path != '/system1']
+    system = ("/system1\r\n  Targets\r\n" + ''.join("    {0}\r\n".format(name) for name in children) +
+              "  Properties\r\n    name=ProLiant DL380 G6\r\n    enabledstate=enabled\r\n" +
+              "    oemhp_PresentPower=316 Watts\r\n  Verbs\r\n    cd version exit show reset start stop\r\n\r\n")
+    block = block.rstrip('\r\n') + "\r\n\r\n" # the sample lacks the end of the last line
+    return [['/system1', header + system]] + [[path, header + path + block] for path in paths if path != '/system1']
+
+def listing(outputs):
+    """Makes the output of `show -l 2 /system1` of the same components"""
+    header = outputs[0][1].partition('/system1')[0]
+    return header + ''.join(output[len(header):] for path, output in outputs)
+
+def timed(func, output, repeat):
+    t0 = time.time()
+    for _ in range(repeat):
+        func(output)
+    return (time.time()-t0)/repeat
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    sample = open(os.path.join(ROOT, 'doc', 'ilo_show_output.txt')).read().replace('\n', '\r\n')
+    notes = open(os.path.join(ROOT, 'doc', 'sensors.txt')).read()
+    system = shows(sample, notes)
+    # name, outputs handled by the old code, output handled by the new one
+    cases = [('ilo_show_output.txt', [['/system1/sensor3', sample]], sample), ('sensors.txt', [['', notes]], notes),
+             ('show /system1', system[:1], system[0][1]), ('poll', system, listing(system))]
+    cases += [(name+', escaped', [[path, output.replace('Celsius', '\xc2\xb0C')] for path, output in old], # a degree sign
+               new.replace('Celsius', '\xc2\xb0C')) for name, old, new in cases if 'Celsius' in new]
+
+    print "{0:>28} {1:>7} {2:>7} {3:>25} {4:>25}".format("", "", "", "sanitize [us]", "parse [us]")
+    print "{0:>28} {1:>7} {2:>7} {3:>8} {4:>8} {5:>7} {6:>8} {7:>8} {8:>7}".format(
+        "case", "outputs", "bytes", "old", "new", "", "old", "new", "")
+    for name, old, new in cases:
+        old = [[path, output.decode('utf-8')] for path, output in old]
+        new = new.decode('utf-8')
+        old_sanitized = [[path, old_sanitize(output)] for path, output in old]
+        new_sanitized = ilo_parser.sanitize(new)
+        assert [output for path, output in old_sanitized] == [ilo_parser.sanitize(output) for path, output in old], name
+        assert old_parse(old_sanitized) == new_parse(new_sanitized), name
+
+        sanitize = [timed(lambda outputs: [old_sanitize(output) for path, output in outputs], old, repeat),
+                    timed(ilo_parser.sanitize, new, repeat)]
+        parse = [timed(old_parse, old_sanitized, repeat), timed(new_parse, new_sanitized, repeat)]
+        print "{0:>28} {1:>7} {2:>7} {3:>8.1f} {4:>8.1f} {5:>6.1f}x {6:>8.1f} {7:>8.1f} {8:>6.1f}x".format(
+            name, len(old), len(new), 1e6*sanitize[0], 1e6*sanitize[1], sanitize[0]/sanitize[1],
+            1e6*parse[0], 1e6*parse[1], parse[0]/parse[1])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Compares the exec transport of SSHiLoSensors (a new channel for every command) with the shell one
+(commands typed into a single interactive session): time of a single `show /system1` and of a whole poll
+(snapshot), both with the recursive show and with every component shown separately.
+
+usage: bench/ilo_transport.py host [user] [password] [polls]"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import sensors
+
+TRANSPORTS = ['exec', 'shell']
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def timed(func, repeat):
+    """Returns median and maximum time of a call"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time()-t0)
+    return median(times), max(times)
+
+def run(host, user, password, transport, polls):
+    ilo = sensors.SSHiLoSensors(host, user, password, transport)
+    try:
+        commands = []
+        execute = ilo.execute
+        ilo.execute = lambda cmd: commands.append(cmd) or execute(cmd)
+
+        ilo.snapshot() # detects components and opens the session
+        results = [('show /system1', 1) + timed(lambda: ilo.show('/system1'), polls)]
+
+        for tree in [True, False]:
+            ilo.tree = tree
+            del commands[:]
+            poll = timed(ilo.snapshot, polls)
+            results.append(('poll, ' + ('tree' if tree else 'separately'), len(commands)//polls) + poll)
+        return results
+    finally:
+        ilo.disconnect()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    host = sys.argv[1]
+    user = sys.argv[2] if len(sys.argv) > 2 else "Administrator"
+    password = sys.argv[3] if len(sys.argv) > 3 else "ChangeMe"
+    polls = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+    print "{0:>10} {1:>22} {2:>9} {3:>12} {4:>9}".format("transport", "", "commands", "median [ms]", "max [ms]")
+    for transport in TRANSPORTS:
+        for name, commands, med, worst in run(host, user, password, transport, polls):
+            print "{0:>10} {1:>22} {2:>9} {3:>12.1f} {4:>9.1f}".format(transport, name, commands, 1000*med, 1000*worst)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Measures how long ServersDAO.server_list(with_health=True) takes, and how many
+queries it issues, as the number of servers grows.
+
+usage: bench/server_list.py [hours of history per server]"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from sqlalchemy import event, select
+
+import database
+
+SERVER_COUNTS = [10, 50, 100, 200, 300]
+SENSORS = ['Ambient Zone', 'CPU 1', 'CPU 2', 'Power Supply Zone', 'I/O Board Zone']
+POWER_SUPPLIES = ['Power Supply 1', 'Power Supply 2']
+REPEAT = 20
+
+def fill(dao, servers, hours):
+    """Inserts a reading of every sensor of every server for each minute of history"""
+    now = int(time.time())
+    conn = dao.engine.connect()
+    conn.execute(database.Server.__table__.insert(),
+                 [{'addr':addr, 'type_':'DL380', 'rack':i%7, 'size':1, 'position':i//7+1} for i, addr in enumerate(servers)])
+    conn.execute(database.SeriesName.__table__.insert(), [{'name':name} for name in SENSORS+POWER_SUPPLIES])
+    server_ids = [id_ for id_, in conn.execute(select([database.Server.id_]))]
+    name_ids = dict(conn.execute(select([database.SeriesName.name, database.SeriesName.id_])).fetchall())
+
+    for minute in range(1, hours*60):
+        timestamp = now-60*minute
+        with conn.begin():
+            conn.execute(database.ServerStatus.__table__.insert(),
+                         [{'timestamp':timestamp, 'server_id':id_, 'status':True} for id_ in server_ids])
+            conn.execute(database.PowerUnits.__table__.insert(),
+                         [{'timestamp':timestamp, 'server_id':id_, 'power_supply_id':name_ids[unit], 'operational':True, 'health':True}
+                          for id_ in server_ids for unit in POWER_SUPPLIES])
+            conn.execute(database.Temperature.__table__.insert(),
+                         [{'timestamp':timestamp, 'server_id':id_, 'sensor_id':name_ids[sensor], 'reading':20}
+                          for id_ in server_ids for sensor in SENSORS])
+    conn.close()
+
+    # the newest readings go through the write path, which keeps track of them
+    sensors_dao = database.SensorsDAO(None) # uses the global engine
+    batch = sensors_dao.batch()
+    for addr in servers:
+        batch.store_server_status(addr, True)
+        for unit in POWER_SUPPLIES:
+            batch.store_power_unit(addr, unit, True, True)
+        for sensor in SENSORS:
+            batch.store_temperature(addr, sensor, 20)
+    sensors_dao.store_batch(batch)
+
+def run(count, hours):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        database.DAO.DBENGINE = database.DAO.READENGINE = None
+        dao = database.ServersDAO('sqlite:///{0}'.format(path))
+        fill(dao, ['server{0:03}-ilo'.format(i) for i in range(count)], hours)
+
+        queries = []
+        event.listen(dao.read_engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statement != 'BEGIN' and queries.append(1))
+
+        t0 = time.time()
+        for _ in range(REPEAT):
+            data = dao.server_list(with_health=True)
+        dt = (time.time()-t0)/REPEAT
+
+        assert len(data) == count and all(row['status'] for row in data)
+        return len(queries)//REPEAT, dt
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+
+    print "{0:>8} {1:>8} {2:>10}".format("servers", "queries", "time [ms]")
+    for count in SERVER_COUNTS:
+        queries, dt = run(count, hours)
+        print "{0:>8} {1:>8} {2:>10.1f}".format(count, queries, 1000*dt)
@@ -0,0 +1,304 @@
+"""
+Compressed columnar files with old raw readings, moved out of the database by SensorsDAO.move_to_archive.
+
+Readings of one history table of one server from one (local) month are kept in a single file,
+<path>/<server ID>/<table>-<YYYY-MM>. A file is a sequence of blocks, appended by every archival run,
+each one holding readings of a single series (e.g. one sensor) from a continuous range of time:
+
+    header   first timestamp, last timestamp, key (sensor ID, -1 if the table has no names),
+             number of readings, size of the payload
+    payload  timestamps as deltas of deltas, then each value column XOR-ed with the previous value,
+             all of them zigzag-encoded varints
+
+Readings are taken every minute, so most deltas of deltas are zero and most values repeat, which makes
+nearly all varints a single byte. Files are read through mmap, skipping blocks outside of the requested range.
+
+Readings older than the retention cutoff, kept in <path>/cutoff, are never read. They are removed from the disk
+by delete_before, which rewrites a file of a partly expired month once its expired part is a day old.
+"""
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain
+from time import mktime
+
+import numpy
+
+
+HEADER = struct.Struct('<qqiII')
+NO_KEY = -1
+
+TRIM_SLACK = 86400 # seconds of expired readings a file may have before it is rewritten
+
+U7 = numpy.uint64(7)
+U1 = numpy.uint64(1)
+
+
+def month_range(timestamp):
+    """Returns the beginning of the (local) month containing a given timestamp and the beginning of the next one"""
+    month = datetime.fromtimestamp(timestamp).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    following = (month+timedelta(days=32)).replace(day=1)
+    return int(mktime(month.timetuple())), int(mktime(following.timetuple()))
+
+
+def zigzag(values):
+    """Maps signed integers to unsigned ones, so that numbers close to zero stay small"""
+    values = numpy.asarray(values, numpy.int64)
+    return ((values << 1) ^ (values >> 63)).astype(numpy.uint64)
+
+def unzigzag(values):
+    values = numpy.asarray(values, numpy.uint64)
+    return (values >> U1).astype(numpy.int64) ^ -(values & U1).astype(numpy.int64)
+
+
+def encode_varints(values):
+    """Encodes unsigned integers as LEB128 varints: 7 bits per byte, the highest bit set on all but the last byte"""
+    values = numpy.asarray(values, numpy.uint64)
+    lengths = numpy.ones(len(values), numpy.int64)
+    rest = values >> U7
+    while rest.any():
+        lengths += rest > 0
+        rest >>= U7
+
+    starts = numpy.cumsum(lengths)-lengths
+    position = numpy.arange(lengths.sum())-numpy.repeat(starts, lengths)
+    groups = (numpy.repeat(values, lengths) >> (U7*position.astype(numpy.uint64))) & numpy.uint64(0x7f)
+
+    data = groups.astype(numpy.uint8)
+    data[position < numpy.repeat(lengths, lengths)-1] |= 0x80
+    return data.tostring()
+
+def decode_varints(data):
+    """Decodes all varints in a buffer at once"""
+    data = numpy.frombuffer(data, numpy.uint8)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.concatenate([[0], ends[:-1]+1])
+    position = numpy.arange(len(data))-numpy.repeat(starts, ends-starts+1)
+    groups = (data & 0x7f).astype(numpy.uint64) << (U7*position.astype(numpy.uint64))
+    return numpy.add.reduceat(groups, starts) # groups of one varint have no bits in common
+
+
+def encode_block(key, timestamps, columns):
+    """Encodes readings of a series (timestamps in ascending order and columns of values, which may be None)"""
+    timestamps = numpy.asarray(timestamps, numpy.int64)
+    deltas = numpy.diff(timestamps)
+    streams = [zigzag(numpy.concatenate([timestamps[:1], deltas[:1], numpy.diff(deltas)]))]
+
+    for column in columns:
+        # 0 stands for None, so every value is shifted by one
+        missing = numpy.fromiter((value is None for value in column), numpy.bool_, len(column))
+        encoded = numpy.fromiter((0 if value is None else value for value in column), numpy.int64, len(column))
+        encoded = numpy.where(missing, numpy.uint64(0), zigzag(encoded)+U1)
+        streams.append(encoded ^ numpy.concatenate([[numpy.uint64(0)], encoded[:-1]]))
+
+    payload = encode_varints(numpy.concatenate(streams))
+    return HEADER.pack(timestamps[0], timestamps[-1], key, len(timestamps), len(payload)) + payload
+
+def decode_payload(payload, count):
+    """Decodes a block payload into an array of timestamps and a list of value columns (with None for missing values)"""
+    streams = decode_varints(payload).reshape(-1, count)
+
+    deltas = numpy.cumsum(unzigzag(streams[0][1:]))
+    timestamps = unzigzag(streams[0][:1])[0]+numpy.concatenate([[0], numpy.cumsum(deltas)])
+
+    columns = []
+    for stream in streams[1:]:
+        encoded = numpy.bitwise_xor.accumulate(stream)
+        values = unzigzag(encoded-U1).tolist()
+        missing = encoded == 0
+        if missing.any():
+            values = [None if miss else value for value, miss in zip(values, missing)]
+        columns.append(values)
+
+    return timestamps, columns
+
+
+class Archive:
+    """A directory of archive files (see the module docstring)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger("lab_monitor.archive.Archive")
+
+    def filename(self, server_id, table, timestamp):
+        """Returns the path of the file of a given table and server containing a given timestamp"""
+        month = datetime.fromtimestamp(timestamp).strftime('%Y-%m')
+        return os.path.join(self.path, str(server_id), '{0}-{1}'.format(table, month))
+
+    @contextmanager
+    def transaction(self):
+        """Yields a function appending a block: append(server_id, table, key, timestamps, columns).
+        All readings must come from a single month. If anything fails, the files are truncated back
+        to their previous size. Every block is on the disk before the with statement ends."""
+        sizes = {}
+
+        def append(server_id, table, key, timestamps, columns):
+            name = self.filename(server_id, table, timestamps[0])
+            if name not in sizes:
+                if not os.path.isdir(os.path.dirname(name)):
+                    os.makedirs(os.path.dirname(name))
+                sizes[name] = os.path.getsize(name) if os.path.exists(name) else 0
+
+            with open(name, 'ab') as f:
+                f.write(encode_block(key, timestamps, columns))
+                f.flush()
+                os.fsync(f.fileno())
+
+        try:
+            yield append
+        except:
+            for name, size in sizes.iteritems():
+                with open(name, 'r+b') as f:
+                    f.truncate(size)
+            raise
+
+    def cutoff(self):
+        """Returns the timestamp before which readings have expired (see delete_before), or None"""
+        try:
+            with open(os.path.join(self.path, 'cutoff')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def set_cutoff(self, cutoff):
+        name = os.path.join(self.path, 'cutoff')
+        with open(name+'.tmp', 'w') as f:
+            f.write(str(int(cutoff)))
+        os.rename(name+'.tmp', name) # readers see either the old one or the new one
+
+    def blocks(self, name, start=None, end=None, decode=True):
+        """Yields (key, timestamps, columns) of blocks of a file overlapping with <start, end> range.
+        Without decoding, yields (key, first timestamp, last timestamp) instead."""
+        if not os.path.exists(name) or os.path.getsize(name) == 0:
+            return
+
+        with open(name, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < len(data):
+                if offset+HEADER.size > len(data):
+                    break # a block is being appended right now
+                first, last, key, count, size = HEADER.unpack_from(data, offset)
+                offset += HEADER.size
+                if offset+size > len(data):
+                    break
+                if (start is None or last >= start) and (end is None or first <= end):
+                    if decode:
+                        timestamps, columns = decode_payload(data[offset:offset+size], count)
+                        yield key, timestamps, columns
+                    else:
+                        yield key, first, last
+                offset += size
+        finally:
+            data.close()
+
+    def read(self, server_id, table, start, end):
+        """Loads readings of a server from <start, end> range as {key: (timestamps, columns)}, ordered by time"""
+        cutoff = self.cutoff()
+        if cutoff is not None:
+            start = max(start, cutoff)
+        if start > end:
+            return {}
+        parts = {}
+        month = month_range(start)[0]
+        while month <= end:
+            for key, timestamps, columns in self.blocks(self.filename(server_id, table, month), start, end):
+                parts.setdefault(key, []).append((timestamps, columns))
+            month = month_range(month)[1]
+
+        data = {}
+        for key, blocks in parts.iteritems():
+            timestamps = numpy.concatenate([timestamps for timestamps, _ in blocks])
+            columns = [list(chain.from_iterable(column)) for column in zip(*[columns for _, columns in blocks])]
+
+            # blocks are appended in order, but one may have been written twice if the process died before committing
+            timestamps, keep = numpy.unique(timestamps, return_index=True)
+            inside = (timestamps >= start) & (timestamps <= end)
+            if not inside.any():
+                continue
+            keep = keep[inside]
+            data[key] = (timestamps[inside], [[column[i] for i in keep] for column in columns])
+
+        return data
+
+    def earliest(self, table):
+        """Returns the earliest archived timestamp of a given table, by server ID"""
+        earliest = {}
+        if not os.path.isdir(self.path):
+            return earliest
+        cutoff = self.cutoff()
+
+        for server_id in self.server_dirs():
+            names = sorted(name for name in self.files(server_id) if name.startswith(table+'-'))
+            for name in names:
+                name = os.path.join(self.path, server_id, name)
+                firsts = [first for _, first, _ in self.blocks(name, cutoff, decode=False) if cutoff is None or first >= cutoff]
+                if cutoff is not None:
+                    # only partly expired blocks have to be decoded
+                    for _, timestamps, _ in self.blocks(name, cutoff, cutoff):
+                        timestamps = timestamps[timestamps >= cutoff]
+                        if len(timestamps):
+                            firsts.append(timestamps[0])
+                if firsts:
+                    earliest[int(server_id)] = int(min(firsts))
+                    break
+
+        return earliest
+
+    def server_dirs(self):
+        return [name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name))]
+
+    def files(self, server_id):
+        """Names of archive files of a server, without the ones being rewritten"""
+        return [name for name in os.listdir(os.path.join(self.path, server_id)) if not name.endswith('.tmp')]
+
+    def delete_before(self, cutoff):
+        """Makes readings older than a given timestamp expire: they aren't read anymore, files of months
+        which ended before it are deleted and the other files are trimmed (see the module docstring).
+        Returns the number of deleted and trimmed files."""
+        changed = 0
+        if not os.path.isdir(self.path):
+            return changed
+        self.set_cutoff(cutoff)
+
+        for server_id in self.server_dirs():
+            for name in self.files(server_id):
+                _, year, month = name.rsplit('-', 2)
+                begins, ends = month_range(mktime(datetime(int(year), int(month), 1).timetuple()))
+                name = os.path.join(self.path, server_id, name)
+                if ends <= cutoff:
+                    os.remove(name)
+                    changed += 1
+                elif begins < cutoff-TRIM_SLACK and self.trim(name, cutoff, cutoff-TRIM_SLACK):
+                    changed += 1
+
+        return changed
+
+    def trim(self, name, cutoff, before):
+        """Rewrites a file without readings older than cutoff, if it has any older than before.
+        Returns whether it has been rewritten."""
+        if not any(first < before for _, first, _ in self.blocks(name, decode=False)):
+            return False
+
+        with open(name+'.tmp', 'wb') as f:
+            for key, timestamps, columns in self.blocks(name, cutoff):
+                keep = timestamps >= cutoff
+                if keep.any():
+                    f.write(encode_block(key, timestamps[keep], [[value for value, k in zip(column, keep) if k] for column in columns]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(name+'.tmp', name) # readers which have it mapped keep the old one
+        return True
+
+    def delete_server(self, server_id):
+        """Deletes all archived readings of a server"""
+        path = os.path.join(self.path, str(server_id))
+        if os.path.isdir(path):
+            self.log.info("Deleting archived readings of server #%u", server_id)
+            shutil.rmtree(path)
@@ -1,10 +1,15 @@
+import functools
+
 import server as s
 import sensors
 import alarms
 
-def run(size, servers_dao, sensors_dao, monitor=False, monitor_opts=None):
+def run(size, servers_dao, sensors_dao, monitor=False, monitor_opts=None, ilo_transport=None):
     lab = s.Laboratory()
 
+    # components detected by the previous run, so that the servers don't have to be asked again
+    inventory = servers_dao.get_inventory() if monitor else {}
+
     for rackid in range(size):
         rack = s.Rack(rackid)
         lab.add_rack(rack)
@@ -12,7 +17,11 @@ def run(size, servers_dao, sensors_dao, monitor=False, monitor_opts=None):
         serv_list = servers_dao.server_list(rack.id)
         for serv in serv_list:
             hyperv = s.ESXiHypervisor(serv['hypervisor']) if serv['hypervisor'] else None
-            sensors_inst = sensors.SSHiLoSensors(serv['addr']) if monitor else None
+            sensors_inst = None
+            if monitor:
+                sensors_inst = sensors.SSHiLoSensors(serv['addr'], transport=transport_of(serv['addr'], ilo_transport),
+                                                     inventory=inventory.get(serv['addr']))
+                sensors_inst.inventory_updater = functools.partial(servers_dao.store_inventory, serv['addr'])
 
             server = s.Server(serv['addr'], hyperv, sensors_inst, sensors_dao, serv)
             rack.add_server(server)
@@ -22,6 +31,11 @@ def run(size, servers_dao, sensors_dao, monitor=False, monitor_opts=None):
 
     return lab
 
+def transport_of(addr, ilo_transport):
+    """Returns the transport of an iLo server (see SSHiLoSensors) given the ilo_transport config"""
+    ilo_transport = ilo_transport or {}
+    return (ilo_transport.get('servers') or {}).get(addr, ilo_transport.get('default', 'exec'))
+
 def create_alarms(lab, engine, delay, temperature, shutdown_timeout):
     # Not quite flexible, but I don't know how flexible should it be
 
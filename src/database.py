@@ -1,17 +1,30 @@
 import logging
+import threading
+import time
+import Queue
 from datetime import datetime, timedelta
 from time import strptime, mktime
 from collections import defaultdict
+from itertools import izip, groupby
 
 from contextlib import contextmanager
 
 from sqlalchemy import *
-from sqlalchemy.orm import sessionmaker, relationship, backref, aliased
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.orm import sessionmaker, relationship, backref, aliased, contains_eager
 from sqlalchemy.ext.declarative import declarative_base
+import numpy
+
+import archive
+import migrations
 
 
 Base = declarative_base()
 Session = sessionmaker()
+ReadSession = sessionmaker()
+StreamSession = sessionmaker()
 
 
 @contextmanager
@@ -26,10 +39,33 @@ def session_scope():
     finally:
         session.close()
 
+@contextmanager
+def read_scope():
+    """Like session_scope, but on the pool of read-only connections, which never wait for writers"""
+    session = ReadSession()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+@contextmanager
+def stream_scope():
+    """Like read_scope, but on a connection of its own for long reads (streamed downloads), which would hold up the pool"""
+    session = StreamSession()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
 
 
 class Server(Base):
     __tablename__ = 'servers'
+    __table_args__ = (
+        Index('ix_servers_addr', 'addr'),
+    )
 
     id_ = Column(Integer, primary_key=True)
     addr = Column(String(30))
@@ -62,34 +98,49 @@ class Hypervisor(Base):
 
 
 
+class SeriesName(Base):
+    """Names of temperature sensors and power supplies, stored once instead of on every reading"""
+    __tablename__ = 'series_names'
+
+    id_ = Column(Integer, primary_key=True)
+    name = Column(String(30), unique=True)
+
+
+
 class ServerStatus(Base):
     __tablename__ = 'server_status'
+    __table_args__ = (
+        Index('ix_server_status_server_timestamp', 'server_id', 'timestamp'),
+    )
 
     id_ = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime)
-    server = Column(String(30))
+    timestamp = Column(Integer) # seconds since the epoch
+    server_id = Column(Integer, ForeignKey('servers.id_'))
     status = Column(Boolean)
 
-    def __init__(self, server, status):
-        self.timestamp = datetime.now()
-        self.server = server
+    def __init__(self, server_id, status):
+        self.timestamp = int(time.time())
+        self.server_id = server_id
         self.status = status
 
 
 class PowerUsage(Base):
     __tablename__ = 'power_usage'
+    __table_args__ = (
+        Index('ix_power_usage_server_timestamp', 'server_id', 'timestamp'),
+    )
 
     id_ = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime)
-    server = Column(String(30))
+    timestamp = Column(Integer) # seconds since the epoch
+    server_id = Column(Integer, ForeignKey('servers.id_'))
     present = Column(Integer)
     average = Column(Integer)
     minimum = Column(Integer)
     maximum = Column(Integer)
 
-    def __init__(self, server, present, average, minimum, maximum):
-        self.timestamp = datetime.now()
-        self.server = server
+    def __init__(self, server_id, present, average, minimum, maximum):
+        self.timestamp = int(time.time())
+        self.server_id = server_id
         self.present = present
         self.average = average
         self.minimum = minimum
@@ -98,40 +149,207 @@ class PowerUsage(Base):
 
 class PowerUnits(Base):
     __tablename__ = 'power_units'
+    __table_args__ = (
+        Index('ix_power_units_server_timestamp', 'server_id', 'timestamp'),
+        Index('ix_power_units_server_power_supply_timestamp', 'server_id', 'power_supply_id', 'timestamp'),
+    )
 
     id_ = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime)
-    server = Column(String(30))
-    power_supply = Column(String(30))
+    timestamp = Column(Integer) # seconds since the epoch
+    server_id = Column(Integer, ForeignKey('servers.id_'))
+    power_supply_id = Column(Integer, ForeignKey('series_names.id_'))
     operational = Column(Boolean)
     health = Column(Boolean)
 
-    def __init__(self, server, power_supply, operational, health):
-        self.timestamp = datetime.now()
-        self.server = server
-        self.power_supply = power_supply
+    def __init__(self, server_id, power_supply_id, operational, health):
+        self.timestamp = int(time.time())
+        self.server_id = server_id
+        self.power_supply_id = power_supply_id
         self.operational = operational
         self.health = health
 
 
 class Temperature(Base):
     __tablename__ = 'temperature'
+    __table_args__ = (
+        Index('ix_temperature_server_timestamp', 'server_id', 'timestamp'),
+        Index('ix_temperature_server_sensor_timestamp', 'server_id', 'sensor_id', 'timestamp'),
+    )
 
     id_ = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime)
-    server = Column(String(30))
-    sensor = Column(String(30))
+    timestamp = Column(Integer) # seconds since the epoch
+    server_id = Column(Integer, ForeignKey('servers.id_'))
+    sensor_id = Column(Integer, ForeignKey('series_names.id_'))
     reading = Column(Integer)
 
-    def __init__(self, server, sensor, reading):
-        self.timestamp = datetime.now()
-        self.server = server
-        self.sensor = sensor
+    def __init__(self, server_id, sensor_id, reading):
+        self.timestamp = int(time.time())
+        self.server_id = server_id
+        self.sensor_id = sensor_id
         self.reading = reading
 
 
+HISTORY_TABLES = [ServerStatus, PowerUsage, PowerUnits, Temperature]
+
+# history columns referring to series_names, by their names in ReadingsBatch rows (where they are plain strings)
+NAME_COLUMNS = {Temperature: 'sensor', PowerUnits: 'power_supply'}
+
+# history tables whose old readings can be moved to the archive, with their value columns
+ARCHIVE_COLUMNS = {Temperature: ['reading'], PowerUsage: ['present', 'average', 'minimum', 'maximum']}
+
+# slowly changing history tables, whose rows are only stored when any of these columns changes (or as a heartbeat)
+ON_CHANGE_COLUMNS = {ServerStatus: ['status'], PowerUnits: ['operational', 'health']}
+
+
+# resolutions of chart data, in seconds; readings are taken every minute
+RAW = 60
+HOUR = 3600
+DAY = 86400
+ROLLUP_RESOLUTIONS = [HOUR, DAY]
+
+
+class Rollup(Base):
+    """Aggregates of one series (a sensor, a power supply, a power usage column...) over an hour or a day"""
+    __tablename__ = 'rollups'
+    __table_args__ = (
+        Index('ix_rollups_key', 'series', 'server_id', 'resolution', 'bucket', 'name', unique=True),
+        Index('ix_rollups_bucket', 'bucket'),
+    )
+
+    id_ = Column(Integer, primary_key=True)
+    series = Column(String(30)) # name of the history table
+    server_id = Column(Integer, ForeignKey('servers.id_'))
+    resolution = Column(Integer)
+    bucket = Column(Integer) # beginning of the hour or day
+    name = Column(String(30))
+    count = Column(Integer)
+    total = Column(Integer)
+    minimum = Column(Integer)
+    maximum = Column(Integer)
+
+
+class LatestReading(Base):
+    """The newest value of every series (see Rollup) of every server, updated on every write"""
+    __tablename__ = 'latest_readings'
+
+    server_id = Column(Integer, ForeignKey('servers.id_'), primary_key=True)
+    series = Column(String(30), primary_key=True)
+    name = Column(String(30), primary_key=True)
+    timestamp = Column(Integer) # seconds since the epoch
+    value = Column(Integer)
+
+
+class TimeBounds(Base):
+    """The earliest and the latest timestamp of each history table, by server, updated on every write"""
+    __tablename__ = 'time_bounds'
+
+    series = Column(String(30), primary_key=True)
+    server_id = Column(Integer, ForeignKey('servers.id_'), primary_key=True)
+    earliest = Column(Integer)
+    latest = Column(Integer)
+
+
+class ComponentInventory(Base):
+    """Temperature sensors and power supplies detected on the iLo of each server, so that a restarted monitor
+    can poll them right away. The fingerprint tells if the targets of /system1 they were found among have changed."""
+    __tablename__ = 'component_inventory'
+
+    server_id = Column(Integer, ForeignKey('servers.id_'), primary_key=True)
+    fingerprint = Column(String(40))
+    sensors = Column(Text) # paths separated by spaces
+    power_supplies = Column(Text)
+    detected = Column(Integer) # seconds since the epoch
+
+
+def toepoch(timestamp):
+    """Converts a (local) datetime object to seconds since the epoch"""
+    return int(mktime(timestamp.timetuple()))
+
+
+def rollup_bucket(timestamp, resolution):
+    """Returns the beginning of the (local) hour or day that contains a given timestamp"""
+    local = datetime.fromtimestamp(timestamp)
+    if resolution == HOUR:
+        return toepoch(local.replace(minute=0, second=0, microsecond=0))
+    return toepoch(local.replace(hour=0, minute=0, second=0, microsecond=0))
+
+
+# functions accepted by SensorsDAO.aggregate
+AGGREGATES = ['min', 'max', 'avg', 'count']
+
+
+def bucket_partials(timestamps, values, bucket):
+    """Computes (bucket, count, total, minimum, maximum) of readings (ordered by time, with no None values)
+    in buckets of a given size, aligned to its multiples"""
+    if not len(timestamps):
+        return []
+    timestamps = numpy.asarray(timestamps, numpy.int64)
+    values = numpy.asarray(values)
+    buckets = timestamps - timestamps % bucket
+    starts = numpy.flatnonzero(numpy.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    counts = numpy.diff(numpy.append(starts, len(buckets)))
+    return zip(buckets[starts].tolist(), counts.tolist(), numpy.add.reduceat(values, starts).tolist(),
+               numpy.minimum.reduceat(values, starts).tolist(), numpy.maximum.reduceat(values, starts).tolist())
+
+
+def series_points(table, row):
+    """Splits a history row (as a dictionary) into (name, value) pairs, named the same way as in get_* results"""
+    if table is Temperature:
+        return [(row['sensor'], row['reading'])]
+    if table is PowerUsage:
+        return [(col, row[col]) for col in ['present', 'average', 'minimum', 'maximum']]
+    if table is PowerUnits:
+        return [(row['power_supply'], int(row['operational'] and row['health']))]
+    return [('status', int(row['status']))]
+
+
+def series_columns(table):
+    """SQL counterpart of series_points: (name, value) expressions of a history table, selected from series_from(table)"""
+    if table is Temperature:
+        return [(SeriesName.name, Temperature.reading)]
+    if table is PowerUsage:
+        return [(literal(col), getattr(PowerUsage, col)) for col in ['present', 'average', 'minimum', 'maximum']]
+    if table is PowerUnits:
+        return [(SeriesName.name, cast(and_(PowerUnits.operational, PowerUnits.health), Integer))]
+    return [(literal('status'), cast(ServerStatus.status, Integer))]
+
+
+def series_from(table):
+    """Joins a history table with series_names, if its readings are named"""
+    if table in NAME_COLUMNS:
+        name_id = getattr(table, NAME_COLUMNS[table]+'_id')
+        return table.__table__.join(SeriesName.__table__, name_id==SeriesName.id_)
+    return table.__table__
+
+
+def earliest_rollup(table, server_id):
+    """SQL expression finding the beginning of the oldest rollup of a server (an ID or an expression) in a given table"""
+    return select([func.min(Rollup.bucket)]).where(and_(Rollup.series==table.__tablename__, Rollup.server_id==server_id)).as_scalar()
+
+
+def least(a, b):
+    """SQL expression of the smaller of two values, ignoring NULL"""
+    return case([(a<b, a)], else_=func.coalesce(b, a))
+
+
+def server_id_of(addr):
+    """SQL expression looking up the ID of a server by its address"""
+    return select([Server.id_]).where(Server.addr==addr).limit(1).as_scalar()
+
+
 class DAO:
     DBENGINE = None
+    READENGINE = None
+    STREAMENGINE = None
+
+    archive = None # archive.Archive with old raw readings, if they are archived
+
+    chunk_size = 1000 # rows deleted in one transaction by delete_chunked
+    chunk_pause = 0.05 # seconds between the transactions, so that other writers can get in
+
+    read_pool_size = 4 # connections for concurrent readers (the writer has a single one)
+    busy_timeout = 15 # seconds to wait for another process to finish writing
+    cache_size = 8192 # KiB of page cache per connection
 
     def __init__(self, db, engine=None):
         """Initializes a Data Access Object, utilizing an existing engine if available (otherwise it creates one)"""
@@ -143,13 +361,74 @@ class DAO:
                 self.log.info("Global engine is available")
             else:
                 self.log.info("Global engine not found, creating one")
-                DAO.DBENGINE = create_engine(db)
+                DAO.DBENGINE, DAO.READENGINE, DAO.STREAMENGINE = self.create_engines(db)
+                migrations.migrate(DAO.DBENGINE)
                 Base.metadata.create_all(DAO.DBENGINE)
                 Session.configure(bind=DAO.DBENGINE)
+                ReadSession.configure(bind=DAO.READENGINE)
+                StreamSession.configure(bind=DAO.STREAMENGINE)
 
             self.engine = DAO.DBENGINE
+            self.read_engine = DAO.READENGINE
         else:
-            self.engine = engine
+            self.engine = self.read_engine = engine
+
+    def create_engines(self, db):
+        """Creates an engine for writing, one for reading and one for long streamed reads. A SQLite file gets a single
+        write connection and a pool of read connections, which thanks to WAL journaling don't block each other,
+        and every stream opens a connection of its own."""
+        url = make_url(db)
+        if url.drivername.split('+')[0] != 'sqlite' or url.database in (None, '', ':memory:'):
+            # every connection to an in-memory database would see a different one
+            engine = create_engine(db)
+            return engine, engine, engine
+
+        # BEGIN IMMEDIATE takes the write lock up front, so that two writers never deadlock upgrading their locks
+        writer = self.create_sqlite_engine(db, 1, "BEGIN IMMEDIATE")
+        reader = self.create_sqlite_engine(db, self.read_pool_size, "BEGIN")
+        streamer = self.create_sqlite_engine(db, None, "BEGIN")
+        return writer, reader, streamer
+
+    def create_sqlite_engine(self, db, pool_size, begin):
+        """Creates an engine with a fixed pool of tuned SQLite connections (or with no pool if pool_size is None),
+        which start transactions with a given statement"""
+        connect_args = {'timeout': self.busy_timeout, 'check_same_thread': False}
+        if pool_size is None:
+            engine = create_engine(db, poolclass=NullPool, connect_args=connect_args)
+        else:
+            engine = create_engine(db, poolclass=QueuePool, pool_size=pool_size, max_overflow=0, connect_args=connect_args)
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            # pysqlite begins transactions on its own and commits before any DDL, so take it over
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent, only the last commits can be lost on power failure
+            cursor.execute("PRAGMA cache_size=-{0}".format(self.cache_size))
+            cursor.close()
+
+        @event.listens_for(engine, 'begin')
+        def begin_transaction(conn):
+            conn.execute(begin)
+
+        return engine
+
+    def delete_chunked(self, table, condition, deadline=None):
+        """Deletes matching rows in many small transactions instead of a long one which would lock the database.
+        Stops when time.time() reaches the deadline. Returns the number of deleted rows and whether all have been deleted."""
+        deleted = 0
+        while True:
+            with session_scope() as session:
+                chunk = select([table.id_]).where(condition).limit(self.chunk_size)
+                count = session.execute(table.__table__.delete().where(table.id_.in_(chunk))).rowcount
+            deleted += count
+
+            if count < self.chunk_size:
+                return deleted, True
+            if deadline is not None and time.time() >= deadline:
+                return deleted, False
+            time.sleep(self.chunk_pause)
 
 
 
@@ -163,53 +442,52 @@ class ServersDAO(DAO):
 
     def server_list(self, rack=None, with_health=False):
         """Returns all monitored servers as a list of dictionaries"""
-        with session_scope() as session:
+        with read_scope() as session:
             data = []
 
-            q = session.query(Server).outerjoin(Server.hypervisor).filter(Server.rack==rack if rack is not None else True)
+            if with_health:
+                health = self.health_summary(session)
+
+            q = session.query(Server).outerjoin(Server.hypervisor).options(contains_eager(Server.hypervisor)) \
+                .filter(Server.rack==rack if rack is not None else True)
             for serv in q:
                 row = {'id':serv.id_, 'addr':serv.addr, 'type':serv.type_, 'rack':serv.rack, 'size':serv.size, 'position':serv.position, 'hypervisor':None}
                 if serv.hypervisor is not None:
                     row['hypervisor'] = serv.hypervisor.addr
 
                 if with_health:
-                    try:
-                        status = session.query(ServerStatus) \
-                            .filter(ServerStatus.server==serv.addr) \
-                            .order_by(desc(ServerStatus.timestamp)) \
-                            .first()
-
-                        row['status'] = status.status
-                    except Exception:
-                        row['status'] = False
-
-                    try:
-                        power_units = session.query(PowerUnits) \
-                            .filter(PowerUnits.server==serv.addr) \
-                            .group_by(PowerUnits.power_supply) \
-                            .order_by(PowerUnits.power_supply)
-
-                        row['power_supplies'] = [unit.health and unit.operational for unit in power_units]
-                    except Exception:
-                        row['power_supplies'] = []
-
-                    try:
-                        temperature = session.query(Temperature) \
-                            .filter(Temperature.server==serv.addr, Temperature.sensor=='Ambient Zone') \
-                            .order_by(desc(Temperature.timestamp)) \
-                            .first()
-
-                        row['temperature'] = u"{0}\u00b0".format(temperature.reading)
-                    except Exception:
-                        row['temperature'] = '?'
+                    row.update(health.get(serv.id_, {}))
+                    row.setdefault('status', False)
+                    row.setdefault('power_supplies', [])
+                    row.setdefault('temperature', '?')
 
                 data.append(row)
 
             return data
 
+    def health_summary(self, session):
+        """Loads the latest status, power supply states and Ambient Zone temperature of all servers in one query.
+        Returns a dictionary of partial server_list rows, by server ID."""
+        q = session.query(LatestReading) \
+            .filter(or_(LatestReading.series.in_([ServerStatus.__tablename__, PowerUnits.__tablename__]),
+                        and_(LatestReading.series==Temperature.__tablename__, LatestReading.name=='Ambient Zone'))) \
+            .order_by(LatestReading.server_id, LatestReading.name)
+
+        health = defaultdict(dict)
+        for latest in q:
+            row = health[latest.server_id]
+            if latest.series == ServerStatus.__tablename__:
+                row['status'] = bool(latest.value)
+            elif latest.series == PowerUnits.__tablename__:
+                row.setdefault('power_supplies', []).append(bool(latest.value))
+            else:
+                row['temperature'] = u"{0}\u00b0".format(latest.value)
+
+        return health
+
     def server_has_hypervisor(self, id_, except_for=None):
         """Checks if a given server has a corresponding ESXi hypervisor"""
-        with session_scope() as session:
+        with read_scope() as session:
             q = session.query(Server).join(Server.hypervisor).filter(Server.id_==id_)
             if except_for is None:
                 return q.count()
@@ -218,7 +496,7 @@ class ServersDAO(DAO):
 
     def server_position(self, rack, position0, position1, except_for=None):
         """Searches for servers on given place (rack number, bottom position, top position). Optionally excludes a server with given address."""
-        with session_scope() as session:
+        with read_scope() as session:
             q = session.query(Server) \
                 .filter(Server.rack==rack, position0<=(Server.position+Server.size-1), Server.position<=position1, Server.addr!=except_for if except_for is not None else True)
             return q.count()
@@ -240,8 +518,10 @@ class ServersDAO(DAO):
                 self.log.error("Server cannot be found")
                 return
 
-            for table in [ServerStatus, PowerUsage, PowerUnits, Temperature]:
-                session.query(table).filter(table.server==serv.addr).delete()
+            id_ = serv.id_
+            session.query(LatestReading).filter(LatestReading.server_id==id_).delete()
+            session.query(TimeBounds).filter(TimeBounds.server_id==id_).delete()
+            session.query(ComponentInventory).filter(ComponentInventory.server_id==id_).delete()
 
             hyperv = session.query(Server).join(Server.hypervisor).filter(Server.id_==serv.id_).first()
             if hyperv is not None:
@@ -249,6 +529,14 @@ class ServersDAO(DAO):
 
             session.delete(serv)
 
+        # readings can take a while to delete, the monitor shouldn't wait for it
+        for table in HISTORY_TABLES + [Rollup]:
+            deleted, _ = self.delete_chunked(table, table.server_id==id_)
+            self.log.info("Deleted %u rows of %s", deleted, table.__tablename__)
+
+        if self.archive is not None:
+            self.archive.delete_server(id_)
+
     def server_update(self, id_=None, addr=None, update={}):
         """Updates a server by ID or address"""
         self.log.info("Updating a server (%s)", id_ or addr)
@@ -269,9 +557,26 @@ class ServersDAO(DAO):
             for field, new in update.iteritems():
                 setattr(serv, field, new)
 
+    def get_inventory(self):
+        """Returns components detected on the servers (see SSHiLoSensors): {addr: (fingerprint, sensors, power_supplies)}"""
+        with read_scope() as session:
+            q = session.query(Server.addr, ComponentInventory).join(ComponentInventory, ComponentInventory.server_id==Server.id_)
+            return dict((addr, (inv.fingerprint, inv.sensors.split(), inv.power_supplies.split())) for addr, inv in q)
+
+    def store_inventory(self, addr, fingerprint, sensors, power_supplies):
+        """Stores components detected on a server, replacing the ones detected before"""
+        self.log.info("Storing components of %s", addr)
+        with session_scope() as session:
+            server_id = session.query(Server.id_).filter(Server.addr==addr).limit(1).scalar()
+            if server_id is None:
+                self.log.error("Server cannot be found")
+                return
+            session.merge(ComponentInventory(server_id=server_id, fingerprint=fingerprint, sensors=' '.join(sensors),
+                                             power_supplies=' '.join(power_supplies), detected=int(time.time())))
+
     def hypervisor_list(self, rack=None):
         """Lists all defined ESXi hypervisors"""
-        with session_scope() as session:
+        with read_scope() as session:
             data = []
 
             serv = aliased(Server)
@@ -337,149 +642,859 @@ class ServersDAO(DAO):
 
 class SensorsDAO(DAO):
 
+    # long-range charts use rollups, as long as they give at least that many points
+    chart_min_points = 200
+
+    # unchanged status and power supply states are stored again after that many seconds, to show the monitor was running
+    heartbeat = 3600
+
+    def __init__(self, db, engine=None):
+        DAO.__init__(self, db, engine)
+        self.server_ids = {} # by address
+        self.name_ids = {} # IDs of series_names, which never change
+        self.last_stored = {} # (table, server ID, name ID) -> (timestamp, values) of the newest row of ON_CHANGE_COLUMNS tables
+
     def store_server_status(self, server, status):
         """Inserts server status record to the database"""
         self.log.info("Storing server status of %s", server)
-        with session_scope() as session:
-            session.add(ServerStatus(server, status))
+        batch = self.batch()
+        batch.store_server_status(server, status)
+        self.store_batch(batch)
 
     def store_power_usage(self, server, present, average, minimum, maximum):
         """Inserts power usage record to the database"""
         self.log.info("Storing power usage of %s", server)
-        with session_scope() as session:
-            session.add(PowerUsage(server, present, average, minimum, maximum))
+        batch = self.batch()
+        batch.store_power_usage(server, present, average, minimum, maximum)
+        self.store_batch(batch)
 
     def store_power_unit(self, server, power_supply, operational, health):
         """Inserts power unit record to the database"""
         # this is executed in a loop for each power supply, hence 'debug' level
         self.log.debug("Storing a power unit %s of %s", power_supply, server)
-        with session_scope() as session:
-            session.add(PowerUnits(server, power_supply, operational, health))
+        batch = self.batch()
+        batch.store_power_unit(server, power_supply, operational, health)
+        self.store_batch(batch)
 
     def store_temperature(self, server, sensor, reading):
         """Inserts temperature sensor reading to the database"""
         self.log.debug("Storing a temperature sensor %s of %s", sensor, server) # ditto
+        batch = self.batch()
+        batch.store_temperature(server, sensor, reading)
+        self.store_batch(batch)
+
+    def batch(self):
+        """Returns an empty ReadingsBatch, which has the same store_* methods as this class"""
+        return ReadingsBatch()
+
+    def store_batch(self, batch):
+        """Inserts all readings collected in a batch using bulk inserts in a single transaction"""
+        rows = batch.close()
+        self.log.info("Storing a batch of %u readings", sum(len(r) for r in rows.itervalues()))
         with session_scope() as session:
-            session.add(Temperature(server, sensor, reading))
+            rows, name_ids = self.resolve(session, rows)
+            inserts, last_stored = self.changed_rows(session, rows)
+            for table, values in inserts.iteritems():
+                if values:
+                    session.execute(table.__table__.insert(), values)
+
+            # derived tables account for every reading, stored or not
+            self.update_rollups(session, rows)
+            self.update_latest(session, rows)
+            self.update_time_bounds(session, rows)
+
+        # names interned (or rows stored) by a transaction that has been rolled back mustn't be cached
+        self.name_ids = name_ids
+        self.last_stored = last_stored
+
+    def changed_rows(self, session, rows):
+        """Drops rows of ON_CHANGE_COLUMNS tables repeating the newest stored values of their series, unless it's
+        time for a heartbeat. Returns rows to insert and the updated cache of stored values, valid after commit."""
+        last_stored = dict(self.last_stored)
+        inserts = dict(rows)
+        for table, columns in ON_CHANGE_COLUMNS.iteritems():
+            name_id = NAME_COLUMNS[table]+'_id' if table in NAME_COLUMNS else None
+            inserts[table] = []
+            for row in sorted(rows.get(table, []), key=lambda row: row['timestamp']):
+                key = (table, row['server_id'], row[name_id] if name_id is not None else None)
+                if key not in last_stored:
+                    last_stored[key] = self.newest_stored(session, table, key)
+
+                values = tuple(row[column] for column in columns)
+                newest = last_stored[key]
+                if newest is None or newest[1] != values or row['timestamp']-newest[0] >= self.heartbeat:
+                    inserts[table].append(row)
+                    last_stored[key] = (row['timestamp'], values)
+
+        return inserts, last_stored
+
+    def newest_stored(self, session, table, key):
+        """Loads (timestamp, values) of the newest row of a series of an ON_CHANGE_COLUMNS table, None if there is none"""
+        _, server_id, name_id = key
+        condition = table.server_id==server_id
+        if name_id is not None:
+            condition = and_(condition, getattr(table, NAME_COLUMNS[table]+'_id')==name_id)
+
+        columns = [getattr(table, column) for column in ON_CHANGE_COLUMNS[table]]
+        row = session.execute(select([table.timestamp] + columns).where(condition).order_by(table.timestamp.desc()).limit(1)).first()
+        return (row[0], tuple(row[1:])) if row is not None else None
+
+    def resolve(self, session, rows):
+        """Adds server_id and IDs of names (interning new ones) to batch rows, dropping readings of unknown servers.
+        Returns the rows and the updated name cache, which is valid once the session is committed."""
+        addrs = set(row['server'] for values in rows.itervalues() for row in values)
+        if not addrs.issubset(self.server_ids):
+            # the monitor is restarted whenever servers change, so new addresses are all there is to look up
+            self.server_ids = dict(session.execute(select([Server.addr, Server.id_])).fetchall())
+
+        unknown = addrs.difference(self.server_ids)
+        if unknown:
+            self.log.warning("Dropping readings of unknown servers: %s", ", ".join(sorted(unknown)))
+
+        resolved = defaultdict(list)
+        for table, values in rows.iteritems():
+            for row in values:
+                if row['server'] not in unknown:
+                    resolved[table].append(dict(row, server_id=self.server_ids[row['server']]))
+
+        name_ids = dict(self.name_ids)
+        names = set(row[column] for table, column in NAME_COLUMNS.iteritems() for row in resolved[table])
+        missing = names.difference(name_ids)
+        if missing:
+            new = missing.difference(row[0] for row in session.execute(select([SeriesName.name]).where(SeriesName.name.in_(missing))))
+            if new:
+                session.execute(SeriesName.__table__.insert(), [{'name':name} for name in new])
+            name_ids.update(session.execute(select([SeriesName.name, SeriesName.id_]).where(SeriesName.name.in_(missing))).fetchall())
+
+        for table, column in NAME_COLUMNS.iteritems():
+            for row in resolved[table]:
+                row[column+'_id'] = name_ids[row[column]]
+
+        return resolved, name_ids
+
+    def update_rollups(self, session, rows):
+        """Adds readings (grouped by table, as in ReadingsBatch) to their hourly and daily rollups"""
+        aggregates = {}
+        buckets = {} # hours and days begin on a full minute in every timezone, so it's enough to compute them once per minute
+        for table, values in rows.iteritems():
+            for row in values:
+                for name, value in series_points(table, row):
+                    if value is None:
+                        continue
+                    for resolution in ROLLUP_RESOLUTIONS:
+                        minute = row['timestamp']-row['timestamp']%60
+                        if (minute, resolution) not in buckets:
+                            buckets[minute, resolution] = rollup_bucket(minute, resolution)
+                        key = (table.__tablename__, row['server_id'], resolution, buckets[minute, resolution], name)
+                        count, total, minimum, maximum = aggregates.get(key, (0, 0, value, value))
+                        aggregates[key] = (count+1, total+value, min(minimum, value), max(maximum, value))
+
+        if not aggregates:
+            return
+
+        # a batch usually spans a single hour, so it's cheap to find out which rollups already exist
+        rollup = Rollup.__table__
+        buckets = set(key[3] for key in aggregates)
+        q = select([rollup.c.id_, rollup.c.series, rollup.c.server_id, rollup.c.resolution, rollup.c.bucket, rollup.c.name]) \
+            .where(rollup.c.bucket.in_(buckets))
+        existing = dict((tuple(row[1:]), row[0]) for row in session.execute(q))
+
+        inserts = []
+        updates = []
+        for key, (count, total, minimum, maximum) in aggregates.iteritems():
+            if key in existing:
+                updates.append({'rollup_id':existing[key], 'add_count':count, 'add_total':total, 'new_minimum':minimum, 'new_maximum':maximum})
+            else:
+                series, server_id, resolution, bucket, name = key
+                inserts.append({'series':series, 'server_id':server_id, 'resolution':resolution, 'bucket':bucket, 'name':name,
+                                'count':count, 'total':total, 'minimum':minimum, 'maximum':maximum})
+
+        if inserts:
+            session.execute(rollup.insert(), inserts)
+        if updates:
+            new_minimum = bindparam('new_minimum')
+            new_maximum = bindparam('new_maximum')
+            session.execute(rollup.update().where(rollup.c.id_==bindparam('rollup_id')).values(
+                count=rollup.c.count+bindparam('add_count'),
+                total=rollup.c.total+bindparam('add_total'),
+                minimum=case([(rollup.c.minimum<new_minimum, rollup.c.minimum)], else_=new_minimum),
+                maximum=case([(rollup.c.maximum>new_maximum, rollup.c.maximum)], else_=new_maximum)
+            ), updates)
+
+    def update_latest(self, session, rows):
+        """Upserts the newest values from readings (grouped by table, as in ReadingsBatch) into latest_readings"""
+        newest = {}
+        for table, values in rows.iteritems():
+            for row in values:
+                for name, value in series_points(table, row):
+                    key = (row['server_id'], table.__tablename__, name)
+                    if value is not None and (key not in newest or newest[key][0] <= row['timestamp']):
+                        newest[key] = (row['timestamp'], value)
+
+        if not newest:
+            return
+
+        # there are just a few dozen rows per server, so it's fine to load all the keys
+        latest = LatestReading.__table__
+        existing = set(tuple(row) for row in session.execute(select([latest.c.server_id, latest.c.series, latest.c.name])))
+
+        inserts = []
+        updates = []
+        for (server_id, series, name), (timestamp, value) in newest.iteritems():
+            row = {'key_server':server_id, 'key_series':series, 'key_name':name, 'timestamp':timestamp, 'value':value}
+            (updates if (server_id, series, name) in existing else inserts).append(row)
+
+        if inserts:
+            session.execute(latest.insert().values(server_id=bindparam('key_server'), series=bindparam('key_series'), name=bindparam('key_name')), inserts)
+        if updates:
+            session.execute(latest.update().where(and_(latest.c.server_id==bindparam('key_server'), latest.c.series==bindparam('key_series'),
+                                                       latest.c.name==bindparam('key_name'))), updates)
+
+    def update_time_bounds(self, session, rows):
+        """Extends time_bounds with timestamps of readings (grouped by table, as in ReadingsBatch)"""
+        bounds = {}
+        for table, values in rows.iteritems():
+            for row in values:
+                key = (table.__tablename__, row['server_id'])
+                earliest, latest = bounds.get(key, (row['timestamp'], row['timestamp']))
+                bounds[key] = (min(earliest, row['timestamp']), max(latest, row['timestamp']))
+
+        if not bounds:
+            return
+
+        time_bounds = TimeBounds.__table__
+        existing = set(tuple(row) for row in session.execute(select([time_bounds.c.series, time_bounds.c.server_id])))
+
+        inserts = []
+        updates = []
+        for (series, server_id), (earliest, latest) in bounds.iteritems():
+            row = {'key_series':series, 'key_server':server_id, 'new_earliest':earliest, 'new_latest':latest}
+            (updates if (series, server_id) in existing else inserts).append(row)
+
+        if inserts:
+            session.execute(time_bounds.insert().values(series=bindparam('key_series'), server_id=bindparam('key_server'),
+                                                        earliest=bindparam('new_earliest'), latest=bindparam('new_latest')), inserts)
+        if updates:
+            new_earliest = bindparam('new_earliest')
+            new_latest = bindparam('new_latest')
+            session.execute(time_bounds.update().where(and_(time_bounds.c.series==bindparam('key_series'), time_bounds.c.server_id==bindparam('key_server'))).values(
+                earliest=case([(time_bounds.c.earliest<new_earliest, time_bounds.c.earliest)], else_=new_earliest),
+                latest=case([(time_bounds.c.latest>new_latest, time_bounds.c.latest)], else_=new_latest)
+            ), updates)
 
     def get_time_bounds(self, table, server):
-        """Returns the earliest and the latest timestamp existing in a given table"""
+        """Returns the earliest and the latest timestamp of a server existing in a given table (or in its rollups)"""
+        with read_scope() as session:
+            bounds = session.query(TimeBounds.earliest, TimeBounds.latest) \
+                .filter(TimeBounds.series==table.__tablename__, TimeBounds.server_id==server_id_of(server)) \
+                .first()
+            if bounds is None:
+                # not written since the bounds started to be tracked, an aggregate over the index is quick too
+                raw = session.query(func.min(table.timestamp), func.max(table.timestamp)).filter(table.server_id==server_id_of(server)).one()
+                rollups = session.query(func.min(Rollup.bucket), func.max(Rollup.bucket)) \
+                    .filter(Rollup.series==table.__tablename__, Rollup.server_id==server_id_of(server)).one()
+                lows = [bound for bound in (raw[0], rollups[0]) if bound is not None]
+                highs = [bound for bound in (raw[1], rollups[1]) if bound is not None]
+                bounds = (min(lows), max(highs)) if lows else (None, None)
+
+            low, high = bounds
+            if low is None:
+                return None
+            return self.tojstime(low), self.tojstime(high)
+
+    def get_servers_time_bounds(self, table, servers):
+        """Returns the earliest and the latest timestamp of any of given servers existing in a given table"""
+        with read_scope() as session:
+            low, high = session.query(func.min(TimeBounds.earliest), func.max(TimeBounds.latest)) \
+                .join(Server, Server.id_==TimeBounds.server_id) \
+                .filter(TimeBounds.series==table.__tablename__, Server.addr.in_(servers)) \
+                .one()
+            if low is None:
+                return None
+            return self.tojstime(low), self.tojstime(high)
+
+    def prune(self, retention, deadline=None):
+        """Deletes raw readings and rollups older than the retention policy allows. Retention is a dictionary
+        of numbers of days to keep, by resolution (raw, hour, day); None means forever. Stops at the deadline
+        (see delete_chunked) and returns whether everything has been deleted."""
+        now = int(time.time())
+        targets = []
+        if retention.get('raw') is not None:
+            cutoff = now-retention['raw']*DAY
+            targets += [(table, table.timestamp<cutoff) for table in HISTORY_TABLES]
+        for key, resolution in [('hour', HOUR), ('day', DAY)]:
+            if retention.get(key) is not None:
+                cutoff = now-retention[key]*DAY
+                targets.append((Rollup, and_(Rollup.resolution==resolution, Rollup.bucket<cutoff)))
+
+        if retention.get('raw') is not None and self.archive is not None:
+            changed = self.archive.delete_before(now-retention['raw']*DAY)
+            if changed:
+                self.log.info("Pruned %u archive files", changed)
+            # archived readings before the cutoff are gone, whether their files have changed or not
+            for table in ARCHIVE_COLUMNS:
+                self.refresh_earliest(table)
+
+        for table, condition in targets:
+            deleted, done = self.delete_chunked(table, condition, deadline)
+            if deleted:
+                self.log.info("Pruned %u rows of %s", deleted, table.__tablename__)
+                # the bounds reach the oldest rollups too
+                for refreshed in (HISTORY_TABLES if table is Rollup else [table]):
+                    self.refresh_earliest(refreshed)
+            if not done:
+                return False
+        return True
+
+    def refresh_earliest(self, table):
+        """Updates the earliest timestamps of a history table in time_bounds after deleting old rows.
+        Rollups which outlive raw readings count too, so that charts can reach them."""
         with session_scope() as session:
-            q1 = session.query(table).filter(table.server==server).order_by(table.timestamp)
-            if q1.count():
-                low = q1.first().timestamp
-                q2 = session.query(table).order_by(desc(table.timestamp))
-                high = q2.first().timestamp
-                return self.tojstime(low), self.tojstime(high)
-            return None
-
-    def get_power_usage(self, server, start=None, end=None):
-        """Loads power usage data records from <start, end> range (last day by default)"""
+            raw = select([func.min(table.timestamp)]).where(table.server_id==TimeBounds.server_id).as_scalar()
+            earliest = least(raw, earliest_rollup(table, TimeBounds.server_id))
+            session.query(TimeBounds).filter(TimeBounds.series==table.__tablename__) \
+                .update({TimeBounds.earliest: earliest}, synchronize_session=False)
+
+            if self.archive is not None and table in ARCHIVE_COLUMNS:
+                # older readings may be archived
+                for server_id, earliest in self.archive.earliest(table.__tablename__).iteritems():
+                    session.query(TimeBounds).filter(TimeBounds.series==table.__tablename__, TimeBounds.server_id==server_id) \
+                        .update({TimeBounds.earliest: func.min(func.coalesce(TimeBounds.earliest, earliest), earliest)}, synchronize_session=False)
+
+    def move_to_archive(self, age, deadline=None):
+        """Moves raw readings older than a given number of days to the archive, a day of one server at a time.
+        Stops at the deadline (see delete_chunked) and returns whether everything has been moved."""
+        cutoff = int(time.time())-age*DAY
+        with read_scope() as session:
+            server_ids = [id_ for id_, in session.execute(select([Server.id_]))]
+
+        for table in ARCHIVE_COLUMNS:
+            moved = 0
+            for server_id in server_ids:
+                while True:
+                    with read_scope() as session:
+                        first = session.execute(select([func.min(table.timestamp)]).where(table.server_id==server_id)).scalar()
+                    if first is None or first >= cutoff:
+                        break
+
+                    # a file holds a single month
+                    moved += self.archive_range(table, server_id, first, min(first+DAY, cutoff, archive.month_range(first)[1]))
+
+                    if deadline is not None and time.time() >= deadline:
+                        self.log.info("Archived %u rows of %s", moved, table.__tablename__)
+                        return False
+
+            if moved:
+                self.log.info("Archived %u rows of %s", moved, table.__tablename__)
+        return True
+
+    def archive_range(self, table, server_id, start, end):
+        """Moves readings of a server from <start, end) range to the archive. Returns the number of moved rows."""
+        key = getattr(table, NAME_COLUMNS[table]+'_id') if table in NAME_COLUMNS else literal(archive.NO_KEY)
+        condition = and_(table.server_id==server_id, table.timestamp>=start, table.timestamp<end)
+
+        # the rows are deleted only if all blocks have been written, and the blocks are truncated if the deletion fails
+        with self.archive.transaction() as append:
+            with session_scope() as session:
+                q = select([key, table.timestamp] + [getattr(table, column) for column in ARCHIVE_COLUMNS[table]]) \
+                    .where(condition).order_by(key, table.timestamp)
+                rows = session.execute(q).fetchall()
+                for row_key, series in groupby(rows, lambda row: row[0]):
+                    columns = zip(*series)
+                    append(server_id, table.__tablename__, row_key, columns[1], columns[2:])
+
+                session.execute(table.__table__.delete().where(condition))
+
+        return len(rows)
+
+    def read_archive(self, table, server, start, end):
+        """Loads archived readings of a given table from <start, end> range in the same format as get_raw"""
+        if self.archive is None or table not in ARCHIVE_COLUMNS:
+            return defaultdict(list)
+
+        with read_scope() as session:
+            server_id = session.execute(select([server_id_of(server)])).scalar()
+        if server_id is None:
+            return defaultdict(list)
+        return self.read_archive_servers(table, [server_id], start, end).get(server_id, defaultdict(list))
+
+    def read_archive_servers(self, table, server_ids, start, end):
+        """Loads archived readings of many servers at once, with two queries whatever their number.
+        Returns {server_id: data}, with data of each server like read_archive."""
+        if self.archive is None or table not in ARCHIVE_COLUMNS:
+            return {}
+
+        series = {}
+        with read_scope() as session:
+            # readings archived by a run that died before deleting them would be there twice
+            firsts = dict(session.execute(select([table.server_id, func.min(table.timestamp)])
+                                          .where(table.server_id.in_(server_ids)).group_by(table.server_id)).fetchall())
+            for server_id in server_ids:
+                first = firsts.get(server_id)
+                last = toepoch(end) if first is None else min(toepoch(end), first-1)
+                series[server_id] = self.archive.read(server_id, table.__tablename__, toepoch(start), last)
+
+            keys = set(key for server_series in series.itervalues() for key in server_series)
+            if table in NAME_COLUMNS and keys:
+                names = dict(session.execute(select([SeriesName.id_, SeriesName.name]).where(SeriesName.id_.in_(keys))).fetchall())
+
+        result = {}
+        for server_id, server_series in series.iteritems():
+            data = result[server_id] = defaultdict(list)
+            for key, (timestamps, columns) in server_series.iteritems():
+                jstimes = self.tojstimes(timestamps)
+                if table in NAME_COLUMNS:
+                    data[names[key]] = map(list, izip(jstimes, columns[0]))
+                else:
+                    for name, values in izip(ARCHIVE_COLUMNS[table], columns):
+                        data[name] = map(list, izip(jstimes, values))
+
+        return result
+
+    def pick_resolution(self, start, end):
+        """Returns the coarsest resolution that still gives enough points to draw a chart of <start, end> range"""
+        seconds = (end-start).total_seconds()
+        for resolution in reversed(ROLLUP_RESOLUTIONS):
+            if seconds/resolution >= self.chart_min_points:
+                return resolution
+        return RAW
+
+    def get_rollups(self, table, server, start, end, resolution, aggregate='avg'):
+        """Loads rollups of a given table from <start, end> range. Aggregate is one of: avg, minimum, maximum."""
+        with read_scope() as session:
+            value = cast(Rollup.total, Float)/Rollup.count if aggregate == 'avg' else getattr(Rollup, aggregate)
+            q = select([Rollup.name, Rollup.bucket, value]) \
+                .where(and_(Rollup.series==table.__tablename__, Rollup.server_id==server_id_of(server), Rollup.resolution==resolution,
+                            between(Rollup.bucket, rollup_bucket(toepoch(start), resolution), toepoch(end)))) \
+                .order_by(Rollup.bucket)
+
+            return self.group_series(session.execute(q).fetchall())
+
+    def get_raw(self, table, server, start, end):
+        """Loads raw readings of a given table from <start, end> range as {name: [[JS time, value], ...]},
+        including archived ones"""
+        columns = series_columns(table)
+        with read_scope() as session:
+            q = select([table.timestamp] + [expr for column in columns for expr in column]) \
+                .select_from(series_from(table)) \
+                .where(and_(table.server_id==server_id_of(server), between(table.timestamp, toepoch(start), toepoch(end)))) \
+                .order_by(table.timestamp)
+            rows = session.execute(q).fetchall()
+
+        # archived readings are older than the ones in the database, so they go first
+        data = self.read_archive(table, server, start, end)
+        if not rows:
+            return data
+
+        # a single series per table (except for power usage), each one being (name, value) columns
+        columns = zip(*rows)
+        jstimes = self.tojstimes(columns[0])
+        for i in xrange(1, len(columns), 2):
+            for name, jstime, value in izip(columns[i], jstimes, columns[i+1]):
+                data[name].append([jstime, value])
+
+        return data
+
+    def get_changes(self, table, server, start, end):
+        """Loads an ON_CHANGE_COLUMNS table from <start, end> range as step series, in the same format as get_raw.
+        Each series begins with the value in effect at the start and lasts until the end or the latest reading."""
+        with read_scope() as session:
+            server_id = session.execute(select([server_id_of(server)])).scalar()
+        return self.get_changes_servers(table, [server_id], start, end).get(server_id, defaultdict(list))
+
+    def get_changes_servers(self, table, server_ids, start, end):
+        """Like get_changes, for many servers (by ID) at once: {server ID: {name: [[JS time, value], ...]}}.
+        Takes two queries, whatever the number of servers and series."""
+        start, end = toepoch(start), toepoch(end)
+        (name, value), = series_columns(table)
+        with read_scope() as session:
+            # every series seen since the start, with the newest row before the range
+            carried = select([value]).select_from(series_from(table)) \
+                .where(and_(table.server_id==LatestReading.server_id, name==LatestReading.name, table.timestamp<start)) \
+                .order_by(table.timestamp.desc()).limit(1) \
+                .correlate(LatestReading).as_scalar()
+            q = select([LatestReading.server_id, LatestReading.name, LatestReading.timestamp, carried]) \
+                .where(and_(LatestReading.server_id.in_(server_ids), LatestReading.series==table.__tablename__,
+                            LatestReading.timestamp>=start))
+            latest = {}
+            points = defaultdict(list)
+            for server_id, series_name, last_seen, carried_value in session.execute(q):
+                latest[server_id, series_name] = last_seen
+                if carried_value is not None:
+                    points[server_id, series_name].append((start, carried_value))
+
+            q = select([table.server_id, name, table.timestamp, value]).select_from(series_from(table)) \
+                .where(and_(table.server_id.in_(server_ids), between(table.timestamp, start, end))) \
+                .order_by(table.timestamp)
+            for server_id, series_name, timestamp, row_value in session.execute(q):
+                points[server_id, series_name].append((timestamp, row_value))
+
+        data = {}
+        for key, changes in points.iteritems():
+            steps = []
+            for timestamp, row_value in changes:
+                if steps and steps[-1][1] == row_value:
+                    continue # a heartbeat (or a reading stored before only changes were)
+                if steps and timestamp-RAW > steps[-1][0]:
+                    steps.append((timestamp-RAW, steps[-1][1])) # the previous value was read until a minute before
+                steps.append((timestamp, row_value))
+
+            last_seen = min(end, latest.get(key, end))
+            if last_seen > steps[-1][0]:
+                steps.append((last_seen, steps[-1][1]))
+
+            timestamps, values = zip(*steps)
+            server_id, series_name = key
+            data.setdefault(server_id, defaultdict(list))[series_name] = map(list, izip(self.tojstimes(timestamps), values))
+
+        return data
+
+    def aggregate(self, table, server, start=None, end=None, bucket=5*RAW, funcs=('avg',)):
+        """Aggregates readings of a given table from <start, end> range (last day by default) in buckets of a given
+        number of seconds, aligned to its multiples. Funcs are some of AGGREGATES, the result is {func: {name: [[JS time, value], ...]}}.
+
+        Buckets of whole hours are computed from hourly rollups, other ones from raw (and archived) readings,
+        always with GROUP BY in the database. Status and power supplies are counted minute by minute, as if they were stored every minute."""
+        data = self.aggregate_servers(table, [server], start, end, bucket, funcs)
+        return data.get(server) or dict((f, {}) for f in funcs)
+
+    def aggregate_servers(self, table, servers, start=None, end=None, bucket=5*RAW, funcs=('avg',), names=None):
+        """Aggregates readings of many servers at once, like aggregate, optionally only of series with given names.
+        Returns {server: {func: {name: [[JS time, value], ...]}}}, with a single query per table (and value column)."""
         if end is None:
             end = datetime.now()
         if start is None:
             start = end-timedelta(days=1)
+        for f in funcs:
+            if f not in AGGREGATES:
+                raise ValueError("Unknown aggregate function {0}".format(f))
+        start, end = toepoch(start), toepoch(end)
+        start -= start % bucket
+
+        with read_scope() as session:
+            addrs = dict(session.execute(select([Server.id_, Server.addr]).where(Server.addr.in_(servers))).fetchall())
+        if not addrs:
+            return {}
+
+        partials = []
+        if bucket % HOUR == 0:
+            bucket_col = Rollup.bucket - Rollup.bucket % bucket
+            condition = and_(Rollup.series==table.__tablename__, Rollup.server_id.in_(addrs.keys()), Rollup.resolution==HOUR,
+                             between(Rollup.bucket, start, end))
+            if names is not None:
+                condition = and_(condition, Rollup.name.in_(names))
+            q = select([Rollup.server_id, Rollup.name, bucket_col, func.sum(Rollup.count), func.sum(Rollup.total), func.min(Rollup.minimum), func.max(Rollup.maximum)]) \
+                .where(condition) \
+                .group_by(Rollup.server_id, Rollup.name, bucket_col)
+            with read_scope() as session:
+                partials += session.execute(q).fetchall()
+
+        elif table in ON_CHANGE_COLUMNS:
+            # only changes are stored, so the steps are spread back over the minutes
+            changes = self.get_changes_servers(table, addrs.keys(), datetime.fromtimestamp(start), datetime.fromtimestamp(end))
+            for server_id, series in changes.iteritems():
+                for name, points in series.iteritems():
+                    if names is not None and name not in names:
+                        continue
+                    timestamps, values = numpy.array(points, numpy.int64).T
+                    timestamps //= 1000
+                    minutes = numpy.arange(timestamps[0], timestamps[-1]+1, RAW)
+                    values = values[numpy.searchsorted(timestamps, minutes, 'right')-1]
+                    partials += [(server_id, name)+partial for partial in bucket_partials(minutes, values, bucket)]
 
-        with session_scope() as session:
-            data = {'present':[], 'average':[], 'minimum':[], 'maximum':[]}
+        else:
+            with read_scope() as session:
+                bucket_col = table.timestamp - table.timestamp % bucket
+                for name, value in series_columns(table):
+                    condition = and_(table.server_id.in_(addrs.keys()), between(table.timestamp, start, end), value!=None)
+                    if table in NAME_COLUMNS:
+                        keys = [table.server_id, name, bucket_col]
+                        if names is not None:
+                            condition = and_(condition, name.in_(names))
+                    else:
+                        # unnamed series (e.g. power usage columns) are literals, grouping by them is pointless
+                        keys = [table.server_id, bucket_col]
+                        if names is not None and name.value not in names:
+                            continue
+                    q = select([table.server_id, name, bucket_col, func.count(value), func.sum(value), func.min(value), func.max(value)]) \
+                        .select_from(series_from(table)) \
+                        .where(condition) \
+                        .group_by(*keys)
+                    partials += session.execute(q).fetchall()
+
+            archives = self.read_archive_servers(table, addrs.keys(), datetime.fromtimestamp(start), datetime.fromtimestamp(end))
+            for server_id, archived in archives.iteritems():
+                for name, points in archived.iteritems():
+                    points = [point for point in points if point[1] is not None]
+                    if points and (names is None or name in names):
+                        jstimes, values = zip(*points)
+                        partials += [(server_id, name)+partial for partial in bucket_partials(numpy.array(jstimes)//1000, values, bucket)]
+
+        # a bucket may be partly archived and partly in the database
+        merged = {}
+        for server_id, name, bucket_start, count, total, minimum, maximum in partials:
+            key = server_id, name, bucket_start
+            if key in merged:
+                previous = merged[key]
+                count, total = count+previous[0], total+previous[1]
+                minimum, maximum = min(minimum, previous[2]), max(maximum, previous[3])
+            merged[key] = (count, total, minimum, maximum)
+
+        data = {}
+        for (server_id, name, bucket_start), (count, total, minimum, maximum) in sorted(merged.iteritems(), key=lambda item: item[0][2]):
+            values = {'min': minimum, 'max': maximum, 'avg': float(total)/count, 'count': count}
+            jstime = self.tojstime(bucket_start)
+            server_data = data.setdefault(addrs[server_id], dict((f, defaultdict(list)) for f in funcs))
+            for f in funcs:
+                server_data[f][name].append([jstime, values[f]])
+
+        return data
+
+    def group_series(self, rows):
+        """Groups (name, timestamp, value) rows into {name: [[JS time, value], ...]}"""
+        data = defaultdict(list)
+        if not rows:
+            return data
 
-            q = session.query(PowerUsage).filter(PowerUsage.server==server, between(PowerUsage.timestamp, start, end)).order_by(PowerUsage.timestamp)
-            for row in q:
-                for col in data.keys():
-                    data[col].append([self.tojstime(row.timestamp), getattr(row, col)])
+        names, timestamps, values = zip(*rows)
+        for name, jstime, value in izip(names, self.tojstimes(timestamps), values):
+            data[name].append([jstime, value])
 
-            return data
+        return data
 
-    def get_power_units(self, server, start=None, end=None):
-        """Loads power units data records from <start, end> range (last day by default)"""
+    def iter_series(self, table, server, start=None, end=None, chunk_size=1000):
+        """Yields (name, [timestamp, value]) pairs of raw readings from <start, end> range (last day by default),
+        ordered by series name and then by timestamp. Rows are fetched from a server-side cursor in chunks,
+        so memory usage doesn't depend on the size of the range (except for archived readings, loaded at once).
+        The cursor has a connection of its own, so a slow download doesn't take one from the read pool."""
         if end is None:
             end = datetime.now()
         if start is None:
             start = end-timedelta(days=1)
 
-        with session_scope() as session:
-            data = defaultdict(list)
+        if table in ON_CHANGE_COLUMNS:
+            # only changes are stored, the series are short
+            data = self.get_changes(table, server, start, end)
+            for name in sorted(data):
+                for point in data[name]:
+                    yield name, point
+            return
+
+        archived = self.read_archive(table, server, start, end)
+
+        with stream_scope() as session:
+            for name, value in series_columns(table):
+                q = session.query(name, table.timestamp, value) \
+                    .select_from(series_from(table)) \
+                    .filter(table.server_id==server_id_of(server), between(table.timestamp, toepoch(start), toepoch(end)), value!=None) \
+                    .order_by(name, table.timestamp) \
+                    .yield_per(chunk_size)
+                current = None
+                for row_name, timestamp, row_value in q:
+                    if row_name != current:
+                        for point in archived.pop(row_name, []):
+                            if point[1] is not None:
+                                yield row_name, point
+                        current = row_name
+                    yield row_name, [self.tojstime(timestamp), row_value]
+
+        # series with no readings left in the database
+        for name in sorted(archived):
+            for point in archived[name]:
+                if point[1] is not None:
+                    yield name, point
+
+    def get_power_usage(self, server, start=None, end=None, resolution=None):
+        """Loads power usage data records from <start, end> range (last day by default).
+        Unless a resolution is given, hourly or daily averages are returned for long ranges."""
+        if end is None:
+            end = datetime.now()
+        if start is None:
+            start = end-timedelta(days=1)
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
 
-            q = session.query(PowerUnits).filter(PowerUnits.server==server, between(PowerUnits.timestamp, start, end)).order_by(PowerUnits.timestamp)
-            for row in q:
-                data[row.power_supply].append([self.tojstime(row.timestamp), int(row.operational and row.health)])
+        data = {'present':[], 'average':[], 'minimum':[], 'maximum':[]}
 
-            return data
+        if resolution != RAW:
+            data.update(self.get_rollups(PowerUsage, server, start, end, resolution))
+        else:
+            data.update(self.get_raw(PowerUsage, server, start, end))
+        return data
 
-    def get_temperature(self, server, start=None, end=None):
-        """Loads temperature data records from <start, end> range (last day by default)"""
+    def get_power_units(self, server, start=None, end=None, resolution=None):
+        """Loads power units data records from <start, end> range (last day by default).
+        Unless a resolution is given, long ranges are loaded from rollups (a unit counts as failed if it failed at least once)."""
         if end is None:
             end = datetime.now()
         if start is None:
             start = end-timedelta(days=1)
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
 
-        with session_scope() as session:
-            data = defaultdict(list)
+        if resolution != RAW:
+            return self.get_rollups(PowerUnits, server, start, end, resolution, 'minimum')
+        return self.get_changes(PowerUnits, server, start, end)
 
-            q = session.query(Temperature).filter(Temperature.server==server, between(Temperature.timestamp, start, end)).order_by(Temperature.timestamp)
-            for row in q:
-                data[row.sensor].append([self.tojstime(row.timestamp), row.reading])
+    def get_temperature(self, server, start=None, end=None, resolution=None):
+        """Loads temperature data records from <start, end> range (last day by default).
+        Unless a resolution is given, hourly or daily averages are returned for long ranges."""
+        if end is None:
+            end = datetime.now()
+        if start is None:
+            start = end-timedelta(days=1)
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
 
-            return data
+        if resolution != RAW:
+            return self.get_rollups(Temperature, server, start, end, resolution)
+        return self.get_raw(Temperature, server, start, end)
 
-    def get_status(self, server, start=None, end=None):
-        """Loads power usage data records from <start, end> range (last day by default)"""
+    def get_status(self, server, start=None, end=None, resolution=None):
+        """Loads power usage data records from <start, end> range (last day by default).
+        Unless a resolution is given, long ranges are loaded from rollups (a server counts as down if it was down at least once)."""
         if end is None:
             end = datetime.now()
         if start is None:
             start = end-timedelta(days=1)
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
 
-        with session_scope() as session:
-            data = {'status':[]}
+        data = {'status':[]}
 
-            q = session.query(ServerStatus).filter(ServerStatus.server==server, between(ServerStatus.timestamp, start, end)).order_by(ServerStatus.timestamp)
-            for row in q:
-                data['status'].append([self.tojstime(row.timestamp), int(row.status)])
-
-            return data
+        if resolution != RAW:
+            data.update(self.get_rollups(ServerStatus, server, start, end, resolution, 'minimum'))
+        else:
+            data.update(self.get_changes(ServerStatus, server, start, end))
+        return data
 
     def get_general(self, server):
         """Loads last Ambient Zone temperature reading, present power usage, power supplies and server status"""
 
-        with session_scope() as session:
-            power_units = session.query(PowerUnits).filter(PowerUnits.server==server).group_by(PowerUnits.power_supply).order_by(PowerUnits.power_supply)
-            temperature = session.query(Temperature) \
-                .filter(Temperature.server==server, Temperature.sensor=='Ambient Zone') \
-                .order_by(desc(Temperature.timestamp)) \
-                .first()
-            power_usage = session.query(PowerUsage) \
-                .filter(PowerUsage.server==server, PowerUsage.present!=None) \
-                .order_by(desc(PowerUsage.timestamp)) \
-                .first()
-            status = session.query(ServerStatus) \
-                .filter(ServerStatus.server==server) \
-                .order_by(desc(ServerStatus.timestamp)) \
-                .first()
+        with read_scope() as session:
+            latest = dict(((row.series, row.name), row.value) for row in session.query(LatestReading).filter(LatestReading.server_id==server_id_of(server)))
 
             data = {}
 
-            try:
-                data['power_units'] = "ok" if reduce(lambda a,b: a and b, (unit.health and unit.operational for unit in power_units)) else "alert"
-            except:
-                data['power_units'] = '?'
+            power_units = [value for (series, name), value in latest.iteritems() if series==PowerUnits.__tablename__]
+            data['power_units'] = ("ok" if all(power_units) else "alert") if power_units else '?'
 
             try:
-                data['temperature'] = u"{0}\u00b0".format(temperature.reading)
-            except:
+                data['temperature'] = u"{0}\u00b0".format(latest[Temperature.__tablename__, 'Ambient Zone'])
+            except KeyError:
                 data['temperature'] = '?'
 
             try:
-                data['power_usage'] = "{0} W".format(power_usage.present)
-            except:
+                data['power_usage'] = "{0} W".format(latest[PowerUsage.__tablename__, 'present'])
+            except KeyError:
                 data['power_usage'] = '?'
 
             try:
-                data['status'] = "ok" if status.status else "alert"
-            except:
+                data['status'] = "ok" if latest[ServerStatus.__tablename__, 'status'] else "alert"
+            except KeyError:
                 data['status'] = '?'
 
             return data
 
     def tojstime(self, timestamp):
-        """Converts a datetime object to the JavaScript epoch (milliseconds since Jan 1, 1970)"""
-        return 1000*mktime(timestamp.timetuple())
+        """Converts seconds since the epoch to the JavaScript time (milliseconds since Jan 1, 1970)"""
+        return 1000*timestamp
+
+    def tojstimes(self, timestamps):
+        """Converts a whole sequence of timestamps with tojstime at once"""
+        return (numpy.fromiter(timestamps, numpy.int64, len(timestamps))*1000).tolist()
+
+
+
+class ReadingsBatch:
+    """Collects readings (e.g. from one monitor cycle) so that they can be stored at once
+    with SensorsDAO.store_batch. It's safe to fill it from many threads."""
+
+    def __init__(self):
+        self.rows = defaultdict(list)
+        self.closed = False
+        self.late = set() # servers whose readings came after closing
+        self.lock = threading.Lock()
+        self.log = logging.getLogger("lab_monitor.database.ReadingsBatch")
+
+    def add(self, table, **values):
+        """Appends a row to a given table; the timestamp is taken now, not when the batch is stored"""
+        values['timestamp'] = int(time.time())
+        with self.lock:
+            if self.closed:
+                if values.get('server') not in self.late:
+                    self.late.add(values.get('server'))
+                    self.log.warning("Batch has already been stored, dropping late readings of %s", values.get('server'))
+                return
+            self.rows[table].append(values)
+
+    def close(self):
+        """Prevents adding new rows and returns the collected ones"""
+        with self.lock:
+            self.closed = True
+            return self.rows
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(r) for r in self.rows.itervalues())
+
+    def servers(self):
+        """Returns addresses of all servers with readings in the batch"""
+        with self.lock:
+            return set(row['server'] for rows in self.rows.itervalues() for row in rows)
+
+    def store_server_status(self, server, status):
+        self.add(ServerStatus, server=server, status=status)
+
+    def store_power_usage(self, server, present, average, minimum, maximum):
+        self.add(PowerUsage, server=server, present=present, average=average, minimum=minimum, maximum=maximum)
+
+    def store_power_unit(self, server, power_supply, operational, health):
+        self.add(PowerUnits, server=server, power_supply=power_supply, operational=operational, health=health)
+
+    def store_temperature(self, server, sensor, reading):
+        self.add(Temperature, server=server, sensor=sensor, reading=reading)
+
+
+class WriteBehind(threading.Thread):
+    """Stores submitted batches in the background, so that a slow flush never delays the next poll"""
+
+    def __init__(self, dao, max_pending=10, on_stored=None):
+        threading.Thread.__init__(self, name="WriteBehind")
+        self.daemon = True
+        self.dao = dao
+        self.on_stored = on_stored # called with every stored batch, once its readings are visible to readers
+        self.queue = Queue.Queue(max_pending)
+        self.log = logging.getLogger("lab_monitor.database.WriteBehind")
+
+    def submit(self, batch):
+        """Queues a batch to be stored. If too many batches are pending, the oldest one is dropped."""
+        while True:
+            try:
+                self.queue.put_nowait(batch)
+                return
+            except Queue.Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.log.error("Database is too slow, dropping a batch of %u readings", len(dropped))
+                except Queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            try:
+                self.dao.store_batch(batch)
+            except Exception:
+                self.log.exception("Cannot store a batch of %u readings", len(batch))
+            else:
+                if callable(self.on_stored):
+                    self.on_stored(batch)
+
+    def stop(self):
+        """Stores all pending batches and terminates the thread"""
+        self.log.info("Flushing pending batches")
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,51 @@
+import numpy
+
+def lttb_indices(x, y, threshold, extremes=True):
+    """Chooses `threshold` points of a series given as numpy arrays (sorted by x), so that its shape is kept,
+    using the Largest-Triangle-Three-Buckets algorithm. With `extremes` set, the lowest and the highest
+    point are always chosen too, so that a short spike (e.g. one that triggered an alarm) never disappears.
+    Returns a sorted array of indices."""
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return numpy.arange(n)
+
+    # the first and the last point are always selected, the others are divided into threshold-2 buckets
+    edges = numpy.linspace(1, n-1, threshold-1).astype(int)
+    sizes = numpy.diff(edges)
+
+    # averages of all the buckets computed at once; for each bucket, we need the average of the next one
+    cumx = numpy.concatenate([[0], numpy.cumsum(x, dtype=float)])
+    cumy = numpy.concatenate([[0], numpy.cumsum(y, dtype=float)])
+    next_x = numpy.append(((cumx[edges[1:]]-cumx[edges[:-1]])/sizes)[1:], x[-1])
+    next_y = numpy.append(((cumy[edges[1:]]-cumy[edges[:-1]])/sizes)[1:], y[-1])
+
+    selected = numpy.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n-1
+
+    a = 0
+    for i in xrange(threshold-2):
+        lo, hi = edges[i], edges[i+1]
+        # doubled areas of triangles (selected point, candidate, average of the next bucket)
+        area = numpy.abs((x[a]-next_x[i])*(y[lo:hi]-y[a]) - (x[a]-x[lo:hi])*(next_y[i]-y[a]))
+        a = lo+area.argmax()
+        selected[i+1] = a
+
+    if extremes:
+        selected = numpy.union1d(selected, [y.argmin(), y.argmax()])
+
+    return selected
+
+def lttb(points, threshold, extremes=True):
+    """Downsamples a list of [x, y] points with lttb_indices. Points with y set to None are skipped."""
+    if len(points) <= threshold:
+        return [p for p in points if p[1] is not None]
+
+    nan = float('nan')
+    x = numpy.fromiter((p[0] for p in points), float, len(points))
+    y = numpy.fromiter((nan if p[1] is None else p[1] for p in points), float, len(points))
+
+    valid = numpy.flatnonzero(~numpy.isnan(y))
+    if len(valid) < len(points):
+        return [points[valid[i]] for i in lttb_indices(x[valid], y[valid], threshold, extremes)]
+    return [points[i] for i in lttb_indices(x, y, threshold, extremes)]
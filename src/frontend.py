@@ -1,8 +1,11 @@
 import datetime
+import functools
+import zlib
 
 from flask import *
 
-from database import ServerStatus, PowerUsage, PowerUnits, Temperature
+from database import ServerStatus, PowerUsage, PowerUnits, Temperature, AGGREGATES, RAW
+import downsample
 
 """
 Before running the frontend, set the following attributes:
@@ -14,6 +17,7 @@ Before running the frontend, set the following attributes:
 - app.monitor_restart - callable (async)
 - app.monitor_status - callable
 - app.servers_changed - callable
+- app.last_write - callable
 - app.lab - Laboratory
 - app.stream - EventStream
 """
@@ -22,6 +26,38 @@ app = Flask(__name__)
 #app.debug = True
 app.jinja_env.filters['unsafejson'] = lambda v: json.dumps(v) # encode to JSON and escape special chars
 
+# JSON responses shorter than that are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+def gzip_chunks(chunks, level=6):
+    """Compresses an iterable of strings into gzip format on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS) # 16+ means a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.after_request
+def gzip_response(response):
+    """Compresses JSON responses (streamed ones too) for clients which accept gzip"""
+    if response.mimetype != 'application/json' or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+
+    if response.is_streamed:
+        response.response = gzip_chunks(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        response.set_data(''.join(gzip_chunks([data])))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 @app.context_processor
 def inject_variables():
     return {'lab': app.lab, 'len': len}
@@ -291,12 +327,37 @@ def monitor_restart():
 def monitor_status():
     return app.monitor_status()
 
+def conditional(view):
+    """Makes a JSON view answer 304 Not Modified, without calling it, if no readings of its server (or of any server,
+    for views without one) have been stored since the client's copy was sent (see app.last_write)"""
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        modified = app.last_write(kwargs.get('server'))
+        if modified is None:
+            return view(**kwargs)
+
+        etag = repr(modified)
+        last_modified = datetime.datetime.utcfromtimestamp(int(modified))
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = request.if_modified_since is not None and request.if_modified_since >= last_modified
+
+        response = Response(status=304) if not_modified else make_response(view(**kwargs))
+        response.set_etag(etag, weak=True) # the same for all encodings
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True # always ask again
+        return response
+    return wrapper
+
 @app.route('/json/servers')
+@conditional
 def json_servers():
     servers = app.servers_dao.server_list(with_health=True)
     return jsonify(servers=servers)
 
 @app.route('/json/server/<server>')
+@conditional
 def json_general(server):
     data = app.sensors_dao.get_general(server)
     return jsonify(**data)
@@ -306,44 +367,252 @@ def rq_time_bounds():
     end = request.args.get('end', None)
     if start is not None:
         try:
-            start = datetime.fromtimestamp(int(start)/1000)
+            start = datetime.datetime.fromtimestamp(int(start)/1000)
         except:
             start = None
     if end is not None:
         try:
-            end = datetime.fromtimestamp(int(end)/1000)
+            end = datetime.datetime.fromtimestamp(int(end)/1000)
         except:
             end = None
 
     return start, end
 
+def rq_since():
+    """Returns the time after which readings were requested with ?since=<JS time> (the last point of a live chart) or None"""
+    try:
+        # timestamps are whole seconds, so the next possible one
+        return datetime.datetime.fromtimestamp(int(request.args['since'])/1000+1)
+    except (KeyError, ValueError):
+        return None
+
+def rq_range():
+    """Returns start, end and resolution of the requested data: raw readings newer than ?since=,
+    or the ?start= and ?end= range with the resolution left to the DAO"""
+    since = rq_since()
+    if since is not None:
+        return since, None, RAW
+    start, end = rq_time_bounds()
+    return start, end, None
+
+def rq_downsample(data):
+    """Reduces each series to the number of points requested with ?points=N (if it's longer)"""
+    try:
+        points = int(request.args['points'])
+    except (KeyError, ValueError):
+        return data
+
+    return dict((name, downsample.lttb(series, points)) for name, series in data.iteritems())
+
+BUCKET_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def rq_bucket():
+    """Returns the size of buckets requested with ?bucket=5m (in s, m, h or d, seconds by default) or None"""
+    bucket = request.args.get('bucket', '')
+    unit = BUCKET_UNITS.get(bucket[-1:])
+    try:
+        seconds = int(bucket[:-1])*unit if unit else int(bucket)
+    except ValueError:
+        return None
+    return seconds if seconds > 0 else None
+
+def aggregated(table, server, bucket):
+    """Returns readings aggregated in buckets, with functions requested with ?agg=max (avg by default,
+    several ones can be separated with commas). For a single function the data have the usual format,
+    otherwise they are {function: data} (in any format, see series_json)."""
+    start, end = rq_time_bounds()
+    funcs = [f for f in request.args.get('agg', 'avg').split(',') if f in AGGREGATES] or ['avg']
+    data = app.sensors_dao.aggregate(table, server, start, end, bucket, funcs)
+    bounds = app.sensors_dao.get_time_bounds(table, server)
+    if len(funcs) == 1:
+        return series_json(data[funcs[0]], bounds)
+    return series_json(data, bounds, nested=True)
+
+def rq_delta():
+    """Checks whether timestamps should be delta-encoded (?delta=1)"""
+    return request.args.get('delta') in ('1', 'true')
+
+def delta_encode(timestamps):
+    """Replaces all timestamps but the first one with differences from the previous one
+    (readings are taken every minute, so they are mostly the same short number)"""
+    return timestamps[:1] + [b-a for a, b in zip(timestamps, timestamps[1:])]
+
+def columnar(data, arrays):
+    """Splits {name: [[timestamp, value], ...]} into {name: {"timestamps": i, "values": [...]}}, where i is
+    an index of the timestamp array in arrays, shared by all the series with the same timestamps"""
+    index = dict((tuple(timestamps), i) for i, timestamps in enumerate(arrays))
+    columns = {}
+    for name, series in data.iteritems():
+        timestamps = tuple(point[0] for point in series)
+        if timestamps not in index:
+            index[timestamps] = len(arrays)
+            arrays.append(list(timestamps))
+        columns[name] = {'timestamps': index[timestamps], 'values': [point[1] for point in series]}
+    return columns
+
+def series_json(data, bounds, nested=False):
+    """Returns series data ({name: series}, or {function: {name: series}} if nested) in the requested format.
+    With ?format=columnar, each distinct array of timestamps is sent once (in "timestamps")
+    and each series refers to it, with its values in a separate array."""
+    if request.args.get('format') != 'columnar':
+        return jsonify(data=data, bounds=bounds)
+
+    arrays = []
+    if nested:
+        data = dict((key, columnar(series, arrays)) for key, series in data.iteritems())
+    else:
+        data = columnar(data, arrays)
+    if rq_delta():
+        arrays = map(delta_encode, arrays)
+    return jsonify(format='columnar', delta=rq_delta(), timestamps=arrays, data=data, bounds=bounds)
+
+def rq_stream():
+    """Checks whether the whole range was requested as a stream (?stream=1)"""
+    return request.args.get('stream') in ('1', 'true')
+
+def json_stream(series, bounds, buffer_size=65536):
+    """Yields the same JSON document as jsonify(data=..., bounds=...) would return, given
+    (name, point) pairs grouped by name, without ever holding the whole document in memory"""
+    chunk = ['{"bounds": ', json.dumps(bounds), ', "data": {']
+    size = 0
+    current = None
+    for name, point in series:
+        if name != current:
+            if current is not None:
+                chunk.append('], ')
+            chunk += [json.dumps(name), ': [', json.dumps(point)]
+            current = name
+        else:
+            chunk += [', ', json.dumps(point)]
+
+        size += 1
+        if size*16 >= buffer_size: # rough, but it's only about not yielding every point separately
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    if current is not None:
+        chunk.append(']')
+    chunk.append('}}')
+    yield ''.join(chunk)
+
+def stream_series(table, server):
+    """Streams raw readings of a given table from the requested range, for exporting long ranges"""
+    start, end = rq_time_bounds()
+    series = app.sensors_dao.iter_series(table, server, start, end)
+    bounds = app.sensors_dao.get_time_bounds(table, server)
+    return Response(stream_with_context(json_stream(series, bounds)), mimetype='application/json')
+
 @app.route('/json/server/<server>/temperature')
+@conditional
 def json_temperature(server):
-    start, end = rq_time_bounds()
-    data = app.sensors_dao.get_temperature(server, start, end)
+    if rq_stream():
+        return stream_series(Temperature, server)
+    bucket = rq_bucket()
+    if bucket:
+        return aggregated(Temperature, server, bucket)
+    start, end, resolution = rq_range()
+    data = app.sensors_dao.get_temperature(server, start, end, resolution)
     bounds = app.sensors_dao.get_time_bounds(Temperature, server)
-    return jsonify(data=data, bounds=bounds)
+    return series_json(rq_downsample(data), bounds)
 
 @app.route('/json/server/<server>/power_usage')
+@conditional
 def json_power_usage(server):
-    start, end = rq_time_bounds()
-    data = app.sensors_dao.get_power_usage(server, start, end)
+    if rq_stream():
+        return stream_series(PowerUsage, server)
+    bucket = rq_bucket()
+    if bucket:
+        return aggregated(PowerUsage, server, bucket)
+    start, end, resolution = rq_range()
+    data = app.sensors_dao.get_power_usage(server, start, end, resolution)
     bounds = app.sensors_dao.get_time_bounds(PowerUsage, server)
-    return jsonify(data=data, bounds=bounds)
+    return series_json(rq_downsample(data), bounds)
 
 @app.route('/json/server/<server>/power_units')
+@conditional
 def json_power_units(server):
-    start, end = rq_time_bounds()
-    data = app.sensors_dao.get_power_units(server, start, end)
+    if rq_stream():
+        return stream_series(PowerUnits, server)
+    bucket = rq_bucket()
+    if bucket:
+        return aggregated(PowerUnits, server, bucket)
+    start, end, resolution = rq_range()
+    data = app.sensors_dao.get_power_units(server, start, end, resolution)
     bounds = app.sensors_dao.get_time_bounds(PowerUnits, server)
-    return jsonify(data=data, bounds=bounds)
+    return series_json(rq_downsample(data), bounds)
 
 @app.route('/json/server/<server>/status')
+@conditional
 def json_status(server):
-    start, end = rq_time_bounds()
-    data = app.sensors_dao.get_status(server, start, end)
+    if rq_stream():
+        return stream_series(ServerStatus, server)
+    bucket = rq_bucket()
+    if bucket:
+        return aggregated(ServerStatus, server, bucket)
+    start, end, resolution = rq_range()
+    data = app.sensors_dao.get_status(server, start, end, resolution)
     bounds = app.sensors_dao.get_time_bounds(ServerStatus, server)
-    return jsonify(data=data, bounds=bounds)
+    return series_json(rq_downsample(data), bounds)
+
+SERIES_TABLES = {'temperature': Temperature, 'power_usage': PowerUsage, 'power_units': PowerUnits, 'status': ServerStatus}
+
+# series compared across servers when ?series= is not given
+DEFAULT_SERIES = {Temperature: 'Ambient Zone', PowerUsage: 'present', PowerUnits: 'Power Supply 1', ServerStatus: 'status'}
+
+def servers_series(table_name, servers):
+    """Returns a single series (?series=..., e.g. Ambient Zone) of many servers, aggregated (?agg=, avg by default)
+    in buckets (?bucket=, picked like the resolution of a single server's chart by default), as columns:
+    {"timestamps": [...], "servers": {addr: [value or null for each timestamp]}, ...}
+    (timestamps can be delta-encoded with ?delta=1)"""
+    try:
+        if table_name not in SERIES_TABLES:
+            raise ValueError("Unknown table {0}".format(table_name))
+        table = SERIES_TABLES[table_name]
+        name = request.args.get('series', DEFAULT_SERIES.get(table))
+        if name is None:
+            raise ValueError("Series name must be given with ?series=")
+        agg = request.args.get('agg', 'avg')
+        if agg not in AGGREGATES:
+            raise ValueError("Aggregate must be one of: {0}".format(', '.join(AGGREGATES)))
+
+        start, end = rq_time_bounds()
+        end = end or datetime.datetime.now()
+        start = start or end-datetime.timedelta(days=1)
+        bucket = rq_bucket() or app.sensors_dao.pick_resolution(start, end)
+
+        data = app.sensors_dao.aggregate_servers(table, servers, start, end, bucket, [agg], [name])
+        bounds = app.sensors_dao.get_servers_time_bounds(table, servers)
+    except Exception as e:
+        return jsonify(error=str(e))
+
+    # buckets are aligned, so the timestamps of all servers are the same (apart from gaps)
+    timestamps = sorted(set(jstime for server in data.itervalues() for jstime, value in server[agg].get(name, [])))
+    index = dict((jstime, i) for i, jstime in enumerate(timestamps))
+    columns = {}
+    for server in servers:
+        column = columns[server] = [None]*len(timestamps)
+        for jstime, value in data.get(server, {}).get(agg, {}).get(name, []):
+            column[index[jstime]] = value
+
+    if rq_delta():
+        timestamps = delta_encode(timestamps)
+    return jsonify(series=name, bucket=bucket, bounds=bounds, delta=rq_delta(), timestamps=timestamps, servers=columns)
+
+@app.route('/json/series/<table>')
+@conditional
+def json_series(table):
+    servers = [server for server in request.args.get('servers', '').split(',') if server]
+    return servers_series(table, servers)
+
+@app.route('/json/rack/<int:rack_id>/<table>')
+@conditional
+def json_rack_series(rack_id, table):
+    try:
+        rack = app.lab.racks[rack_id]
+    except LookupError:
+        return jsonify(error="No such rack")
+    return servers_series(table, [server.addr for server in rack.servers])
 
 @app.route('/json/esxi/rack/<int:rack_id>')
 def json_esxi_rack(rack_id):
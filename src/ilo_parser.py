@@ -0,0 +1,97 @@
+"""
+A parser of the output of the iLo command line (DMTF SMASH CLP), e.g. of `show -l 2 /system1`:
+
+    status=0
+    status_tag=COMMAND COMPLETED
+
+    /system1/sensor3
+      Targets
+      Properties
+        DeviceID=Temp 1
+        CurrentReading=50
+      Verbs
+        cd version exit show set
+
+The status of the command comes first, then every shown target: its path and the sections indented
+by two spaces with their entries indented by four. See doc/ilo_show_output.txt for a real one.
+"""
+
+import re
+import string
+
+# a target: its path in a separate line and the sections (entries of each one indented by four spaces)
+TARGET = re.compile(r"^(/\S*)[ \t\r]*\n"
+                    r"(?:  Targets\r?\n((?:    [^\n]*\n)*))?"
+                    r"(?:  Properties\r?\n((?:    [^\n]*\n)*))?"
+                    r"(?:  Verbs\r?\n((?:    [^\n]*\n?)*))?", re.M)
+STATUS = re.compile(r"^(\w+)=([^\r\n]*)", re.M)
+PROPERTY = re.compile(r"    (\w+)=([^\r\n]*)")
+NONPRINTABLE = re.compile(u"[^%s]" % re.escape(string.printable))
+
+
+class Escapes(dict):
+    """Translation table of characters to their escapes (\\0xNN), filled as they come.
+    Printable ones stay as they are."""
+
+    def __init__(self):
+        dict.__init__(self, ((ord(ch), ch) for ch in string.printable))
+
+    def __missing__(self, code):
+        self[code] = u"\\0x%02X" % code
+        return self[code]
+
+ESCAPES = Escapes()
+
+
+def escape(match):
+    return ESCAPES[ord(match.group())]
+
+
+def sanitize(output):
+    """Escapes non-printable characters of the output (undecodable bytes of a str too)"""
+    if isinstance(output, str):
+        output = output.decode('latin-1') # byte for byte
+    # unicode.translate(ESCAPES) would look up every character, most of them printable
+    return NONPRINTABLE.sub(escape, output)
+
+
+class Target:
+    """A target in the output: its path, children, properties and verbs, and the lines it was parsed from"""
+
+    def __init__(self, path, text=''):
+        self.path = path
+        self.targets = []
+        self.properties = {}
+        self.verbs = []
+        self.text = text
+
+    def __repr__(self):
+        return "<Target {0}>".format(self.path)
+
+
+def parse(output):
+    """Parses the whole output in one pass.
+    Returns the status of the command as a dictionary and {path: Target}."""
+    status = None
+    targets = {}
+
+    for match in TARGET.finditer(output):
+        if status is None:
+            status = dict(STATUS.findall(output, 0, match.start()))
+        path, children, properties, verbs = match.groups()
+        target = targets[path] = Target(path, match.group())
+        if children:
+            target.targets = children.split()
+        if properties:
+            target.properties = dict(PROPERTY.findall(properties))
+        if verbs:
+            target.verbs = verbs.split()
+
+    if status is None:
+        status = dict(STATUS.findall(output))
+    return status, targets
+
+
+def properties(output):
+    """Only the properties (key=value lines) of the output, e.g. of `show` of a single target"""
+    return dict(PROPERTY.findall(output))
@@ -4,14 +4,17 @@ import logging, logging.handlers
 import os.path
 import sys
 import subprocess
+import time
 
 import redis
 
 from config import config
+import archive
 import construct_lab
 import database
 import frontend
 import procutils
+import querycache
 import server
 import sse
 
@@ -41,6 +44,7 @@ class LabMonitor:
         # ^ in current implementation a monitor terminates existing process before proceeding 
         self.fe.monitor_status = self.monitor_status
         self.fe.servers_changed = self.servers_changed
+        self.fe.last_write = self.last_write
         self.fe.stream = self.stream
         self.fe.lab = self.lab
 
@@ -67,6 +71,20 @@ class LabMonitor:
             self.monitor_start()
 
         self.fe.lab = self.lab = self.labmaker()
+        self.red.set('lab_monitor.servers_changed', repr(time.time()))
+
+    def last_write(self, server=None):
+        """Returns when readings of a server were last stored by the monitor or, without a server, when readings
+        of any server or the list of servers last changed. None if it's unknown (e.g. Redis is unavailable)."""
+        try:
+            if server is not None:
+                value = self.red.hget('lab_monitor.last_write', server)
+                return float(value) if value else None
+            values = self.red.hvals('lab_monitor.last_write') + [self.red.get('lab_monitor.servers_changed')]
+            values = [float(value) for value in values if value]
+            return max(values) if values else None
+        except redis.RedisError:
+            return None
 
     def start(self, debug=False):
         try:
@@ -100,6 +118,9 @@ if __name__ == '__main__':
         baselog.exception("Cannot connect to the database")
         sys.exit(1)
 
+    if config.get('archive'):
+        servers_dao.archive = sensors_dao.archive = archive.Archive(config['archive']['path'])
+
     labmaker = lambda: construct_lab.run(config['num_racks'], servers_dao, sensors_dao)
 
     try:
@@ -113,6 +134,11 @@ if __name__ == '__main__':
     lm.servers_dao = servers_dao
     lm.set_labmaker(labmaker)
     lm.set_redis(red)
+
+    # the frontend reads through a cache shared with other frontend processes
+    if config.get('cache'):
+        lm.sensors_dao = querycache.QueryCache(sensors_dao, red, lm.last_write, **config['cache'])
+
     lm.set_frontend(frontend.app)
 
     lm.start(debug=True)
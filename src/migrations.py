@@ -0,0 +1,364 @@
+"""
+Schema migrations of existing SQLite databases.
+
+Each step is written in plain SQL against the schema of its own version, so that it keeps
+working after the models in database.py change. A freshly created database gets the latest
+schema from the models and is only marked as up to date.
+"""
+
+import logging
+
+# series of each history table, as in database.series_columns: (table, name, value)
+V1_SERIES = [
+    ('server_status', "'status'", "CAST(status AS INTEGER)"),
+    ('power_usage', "'present'", "present"),
+    ('power_usage', "'average'", "average"),
+    ('power_usage', "'minimum'", "minimum"),
+    ('power_usage', "'maximum'", "maximum"),
+    ('power_units', "power_supply", "CAST((operational AND health) AS INTEGER)"),
+    ('temperature', "sensor", "reading"),
+]
+
+V1_HISTORY_TABLES = ['server_status', 'power_usage', 'power_units', 'temperature']
+
+
+def create_indexes(conn):
+    """Adds composite time-series indexes to the history tables"""
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_server_status_server_timestamp ON server_status (server, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_power_usage_server_timestamp ON power_usage (server, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_power_units_server_timestamp ON power_units (server, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_power_units_server_power_supply_timestamp ON power_units (server, power_supply, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_temperature_server_timestamp ON temperature (server, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_temperature_server_sensor_timestamp ON temperature (server, sensor, timestamp)")
+    conn.execute("ANALYZE") # let the query planner know the indexes are worth using
+
+def backfill_rollups(conn):
+    """Creates the rollups table and computes hourly and daily rollups of the readings stored so far"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS rollups (
+        id_ INTEGER NOT NULL,
+        series VARCHAR(30),
+        server VARCHAR(30),
+        resolution INTEGER,
+        bucket DATETIME,
+        name VARCHAR(30),
+        count INTEGER,
+        total INTEGER,
+        minimum INTEGER,
+        maximum INTEGER,
+        PRIMARY KEY (id_)
+    )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_rollups_key ON rollups (series, server, resolution, bucket, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_rollups_bucket ON rollups (bucket)")
+
+    formats = {3600: '%Y-%m-%d %H:00:00.000000', 86400: '%Y-%m-%d 00:00:00.000000'}
+    for table, name, value in V1_SERIES:
+        for resolution, fmt in formats.iteritems():
+            conn.execute("""INSERT INTO rollups (series, server, resolution, bucket, name, count, total, minimum, maximum)
+                SELECT '{table}', server, {resolution}, strftime('{fmt}', timestamp), {name},
+                       count({value}), sum({value}), min({value}), max({value})
+                FROM {table} WHERE {value} IS NOT NULL
+                GROUP BY server, strftime('{fmt}', timestamp), {name}""".format(table=table, resolution=resolution, fmt=fmt, name=name, value=value))
+
+def fill_latest_readings(conn):
+    """Creates the latest_readings table and finds the newest value of every series stored so far"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS latest_readings (
+        server VARCHAR(30) NOT NULL,
+        series VARCHAR(30) NOT NULL,
+        name VARCHAR(30) NOT NULL,
+        timestamp DATETIME,
+        value INTEGER,
+        PRIMARY KEY (server, series, name)
+    )""")
+
+    for table, name, value in V1_SERIES:
+        conn.execute("""INSERT INTO latest_readings (series, server, name, timestamp, value)
+            SELECT '{table}', t.server, {name} AS row_name, t.timestamp, max({value})
+            FROM {table} AS t JOIN (
+                SELECT server, {name} AS name, max(timestamp) AS timestamp FROM {table}
+                WHERE {value} IS NOT NULL GROUP BY server, {name}
+            ) AS newest ON t.server = newest.server AND {name} = newest.name AND t.timestamp = newest.timestamp
+            GROUP BY t.server, row_name, t.timestamp""".format(table=table, name=name, value=value))
+
+def fill_time_bounds(conn):
+    """Creates the time_bounds table and finds the earliest and the latest timestamp of each server in every history table"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS time_bounds (
+        series VARCHAR(30) NOT NULL,
+        server VARCHAR(30) NOT NULL,
+        earliest DATETIME,
+        latest DATETIME,
+        PRIMARY KEY (series, server)
+    )""")
+
+    for table in V1_HISTORY_TABLES:
+        conn.execute("""INSERT INTO time_bounds (series, server, earliest, latest)
+            SELECT '{0}', server, min(timestamp), max(timestamp) FROM {0} GROUP BY server""".format(table))
+
+def rebuild_table(conn, table, create, columns, indexes, where=None):
+    """Recreates a table with a new definition (SQLite can't alter columns), copying all rows (or those matching
+    a where clause). Columns is a list of (new column, SQL expression computing it from the old row) pairs."""
+    for index in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", table).fetchall():
+        conn.execute("DROP INDEX {0}".format(index[0]))
+
+    conn.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table))
+    conn.execute(create)
+    conn.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {0}_old{3}".format(
+        table, ', '.join(column for column, _ in columns), ', '.join(expression for _, expression in columns),
+        " WHERE " + where if where is not None else ""))
+    conn.execute("DROP TABLE {0}_old".format(table))
+
+    for index in indexes:
+        conn.execute(index)
+
+def epoch_timestamps(conn):
+    """Converts all timestamps from local date strings to integer seconds since the epoch"""
+    # the 'utc' modifier treats a date as local time, just like time.mktime does
+    epoch = "CAST(strftime('%s', {0}, 'utc') AS INTEGER)".format
+
+    rebuild_table(conn, 'server_status', """CREATE TABLE server_status (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server VARCHAR(30),
+            status BOOLEAN,
+            PRIMARY KEY (id_),
+            CHECK (status IN (0, 1))
+        )""",
+        [('id_', 'id_'), ('timestamp', epoch('timestamp')), ('server', 'server'), ('status', 'status')],
+        ["CREATE INDEX ix_server_status_server_timestamp ON server_status (server, timestamp)"])
+
+    rebuild_table(conn, 'power_usage', """CREATE TABLE power_usage (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server VARCHAR(30),
+            present INTEGER,
+            average INTEGER,
+            minimum INTEGER,
+            maximum INTEGER,
+            PRIMARY KEY (id_)
+        )""",
+        [('id_', 'id_'), ('timestamp', epoch('timestamp')), ('server', 'server'), ('present', 'present'),
+         ('average', 'average'), ('minimum', 'minimum'), ('maximum', 'maximum')],
+        ["CREATE INDEX ix_power_usage_server_timestamp ON power_usage (server, timestamp)"])
+
+    rebuild_table(conn, 'power_units', """CREATE TABLE power_units (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server VARCHAR(30),
+            power_supply VARCHAR(30),
+            operational BOOLEAN,
+            health BOOLEAN,
+            PRIMARY KEY (id_),
+            CHECK (operational IN (0, 1)),
+            CHECK (health IN (0, 1))
+        )""",
+        [('id_', 'id_'), ('timestamp', epoch('timestamp')), ('server', 'server'), ('power_supply', 'power_supply'),
+         ('operational', 'operational'), ('health', 'health')],
+        ["CREATE INDEX ix_power_units_server_timestamp ON power_units (server, timestamp)",
+         "CREATE INDEX ix_power_units_server_power_supply_timestamp ON power_units (server, power_supply, timestamp)"])
+
+    rebuild_table(conn, 'temperature', """CREATE TABLE temperature (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server VARCHAR(30),
+            sensor VARCHAR(30),
+            reading INTEGER,
+            PRIMARY KEY (id_)
+        )""",
+        [('id_', 'id_'), ('timestamp', epoch('timestamp')), ('server', 'server'), ('sensor', 'sensor'), ('reading', 'reading')],
+        ["CREATE INDEX ix_temperature_server_timestamp ON temperature (server, timestamp)",
+         "CREATE INDEX ix_temperature_server_sensor_timestamp ON temperature (server, sensor, timestamp)"])
+
+    rebuild_table(conn, 'rollups', """CREATE TABLE rollups (
+            id_ INTEGER NOT NULL,
+            series VARCHAR(30),
+            server VARCHAR(30),
+            resolution INTEGER,
+            bucket INTEGER,
+            name VARCHAR(30),
+            count INTEGER,
+            total INTEGER,
+            minimum INTEGER,
+            maximum INTEGER,
+            PRIMARY KEY (id_)
+        )""",
+        [('id_', 'id_'), ('series', 'series'), ('server', 'server'), ('resolution', 'resolution'), ('bucket', epoch('bucket')),
+         ('name', 'name'), ('count', 'count'), ('total', 'total'), ('minimum', 'minimum'), ('maximum', 'maximum')],
+        ["CREATE UNIQUE INDEX ix_rollups_key ON rollups (series, server, resolution, bucket, name)",
+         "CREATE INDEX ix_rollups_bucket ON rollups (bucket)"])
+
+    rebuild_table(conn, 'latest_readings', """CREATE TABLE latest_readings (
+            server VARCHAR(30) NOT NULL,
+            series VARCHAR(30) NOT NULL,
+            name VARCHAR(30) NOT NULL,
+            timestamp INTEGER,
+            value INTEGER,
+            PRIMARY KEY (server, series, name)
+        )""",
+        [('server', 'server'), ('series', 'series'), ('name', 'name'), ('timestamp', epoch('timestamp')), ('value', 'value')],
+        [])
+
+    rebuild_table(conn, 'time_bounds', """CREATE TABLE time_bounds (
+            series VARCHAR(30) NOT NULL,
+            server VARCHAR(30) NOT NULL,
+            earliest INTEGER,
+            latest INTEGER,
+            PRIMARY KEY (series, server)
+        )""",
+        [('series', 'series'), ('server', 'server'), ('earliest', epoch('earliest')), ('latest', epoch('latest'))],
+        [])
+
+    conn.execute("ANALYZE")
+
+def server_ids(conn):
+    """Refers to servers by their IDs instead of addresses and stores sensor and power supply names
+    in the series_names table. Readings of servers which no longer exist are dropped."""
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_servers_addr ON servers (addr)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS series_names (
+        id_ INTEGER NOT NULL,
+        name VARCHAR(30),
+        PRIMARY KEY (id_),
+        UNIQUE (name)
+    )""")
+    conn.execute("""INSERT INTO series_names (name)
+        SELECT sensor FROM temperature UNION SELECT power_supply FROM power_units""")
+
+    server_id = "(SELECT min(id_) FROM servers WHERE addr = server)"
+    name_id = "(SELECT id_ FROM series_names WHERE name = {0})".format
+    known = "server IN (SELECT addr FROM servers)"
+
+    rebuild_table(conn, 'server_status', """CREATE TABLE server_status (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server_id INTEGER,
+            status BOOLEAN,
+            PRIMARY KEY (id_),
+            FOREIGN KEY(server_id) REFERENCES servers (id_),
+            CHECK (status IN (0, 1))
+        )""",
+        [('id_', 'id_'), ('timestamp', 'timestamp'), ('server_id', server_id), ('status', 'status')],
+        ["CREATE INDEX ix_server_status_server_timestamp ON server_status (server_id, timestamp)"], known)
+
+    rebuild_table(conn, 'power_usage', """CREATE TABLE power_usage (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server_id INTEGER,
+            present INTEGER,
+            average INTEGER,
+            minimum INTEGER,
+            maximum INTEGER,
+            PRIMARY KEY (id_),
+            FOREIGN KEY(server_id) REFERENCES servers (id_)
+        )""",
+        [('id_', 'id_'), ('timestamp', 'timestamp'), ('server_id', server_id), ('present', 'present'),
+         ('average', 'average'), ('minimum', 'minimum'), ('maximum', 'maximum')],
+        ["CREATE INDEX ix_power_usage_server_timestamp ON power_usage (server_id, timestamp)"], known)
+
+    rebuild_table(conn, 'power_units', """CREATE TABLE power_units (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server_id INTEGER,
+            power_supply_id INTEGER,
+            operational BOOLEAN,
+            health BOOLEAN,
+            PRIMARY KEY (id_),
+            FOREIGN KEY(server_id) REFERENCES servers (id_),
+            FOREIGN KEY(power_supply_id) REFERENCES series_names (id_),
+            CHECK (operational IN (0, 1)),
+            CHECK (health IN (0, 1))
+        )""",
+        [('id_', 'id_'), ('timestamp', 'timestamp'), ('server_id', server_id), ('power_supply_id', name_id('power_supply')),
+         ('operational', 'operational'), ('health', 'health')],
+        ["CREATE INDEX ix_power_units_server_timestamp ON power_units (server_id, timestamp)",
+         "CREATE INDEX ix_power_units_server_power_supply_timestamp ON power_units (server_id, power_supply_id, timestamp)"], known)
+
+    rebuild_table(conn, 'temperature', """CREATE TABLE temperature (
+            id_ INTEGER NOT NULL,
+            timestamp INTEGER,
+            server_id INTEGER,
+            sensor_id INTEGER,
+            reading INTEGER,
+            PRIMARY KEY (id_),
+            FOREIGN KEY(server_id) REFERENCES servers (id_),
+            FOREIGN KEY(sensor_id) REFERENCES series_names (id_)
+        )""",
+        [('id_', 'id_'), ('timestamp', 'timestamp'), ('server_id', server_id), ('sensor_id', name_id('sensor')), ('reading', 'reading')],
+        ["CREATE INDEX ix_temperature_server_timestamp ON temperature (server_id, timestamp)",
+         "CREATE INDEX ix_temperature_server_sensor_timestamp ON temperature (server_id, sensor_id, timestamp)"], known)
+
+    rebuild_table(conn, 'rollups', """CREATE TABLE rollups (
+            id_ INTEGER NOT NULL,
+            series VARCHAR(30),
+            server_id INTEGER,
+            resolution INTEGER,
+            bucket INTEGER,
+            name VARCHAR(30),
+            count INTEGER,
+            total INTEGER,
+            minimum INTEGER,
+            maximum INTEGER,
+            PRIMARY KEY (id_),
+            FOREIGN KEY(server_id) REFERENCES servers (id_)
+        )""",
+        [('id_', 'id_'), ('series', 'series'), ('server_id', server_id), ('resolution', 'resolution'), ('bucket', 'bucket'),
+         ('name', 'name'), ('count', 'count'), ('total', 'total'), ('minimum', 'minimum'), ('maximum', 'maximum')],
+        ["CREATE UNIQUE INDEX ix_rollups_key ON rollups (series, server_id, resolution, bucket, name)",
+         "CREATE INDEX ix_rollups_bucket ON rollups (bucket)"], known)
+
+    rebuild_table(conn, 'latest_readings', """CREATE TABLE latest_readings (
+            server_id INTEGER NOT NULL,
+            series VARCHAR(30) NOT NULL,
+            name VARCHAR(30) NOT NULL,
+            timestamp INTEGER,
+            value INTEGER,
+            PRIMARY KEY (server_id, series, name),
+            FOREIGN KEY(server_id) REFERENCES servers (id_)
+        )""",
+        [('server_id', server_id), ('series', 'series'), ('name', 'name'), ('timestamp', 'timestamp'), ('value', 'value')],
+        [], known)
+
+    rebuild_table(conn, 'time_bounds', """CREATE TABLE time_bounds (
+            series VARCHAR(30) NOT NULL,
+            server_id INTEGER NOT NULL,
+            earliest INTEGER,
+            latest INTEGER,
+            PRIMARY KEY (series, server_id),
+            FOREIGN KEY(server_id) REFERENCES servers (id_)
+        )""",
+        [('series', 'series'), ('server_id', server_id), ('earliest', 'earliest'), ('latest', 'latest')],
+        [], known)
+
+    conn.execute("ANALYZE")
+
+
+# Each step upgrades the schema by one version. Append new steps at the end, never reorder them.
+MIGRATIONS = [
+    create_indexes,
+    backfill_rollups,
+    fill_latest_readings,
+    fill_time_bounds,
+    epoch_timestamps,
+    server_ids,
+]
+
+
+def migrate(engine):
+    """Applies pending migrations, each one in its own transaction. Call it before creating missing tables.
+    The engine has to take the write lock when a transaction begins (BEGIN IMMEDIATE, as DAO's writer does),
+    so that processes starting at the same time apply every step once."""
+    log = logging.getLogger("lab_monitor.migrations.migrate")
+
+    with engine.begin() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, PRIMARY KEY (version))")
+        version = conn.execute("SELECT max(version) FROM schema_version").scalar()
+        if version is None:
+            fresh = not engine.dialect.has_table(conn, 'server_status')
+            version = len(MIGRATIONS) if fresh else 0
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", version)
+
+    for step, migration in enumerate(MIGRATIONS[version:], version+1):
+        with engine.begin() as conn:
+            # another process may have applied it while this one was waiting for the lock
+            if conn.execute("SELECT max(version) FROM schema_version").scalar() >= step:
+                continue
+            log.info("Migrating the database to version %u (%s)", step, migration.__name__)
+            migration(conn)
+            conn.execute("UPDATE schema_version SET version = ?", step)
@@ -1,11 +1,15 @@
 import logging
 import time
 import threading
+import Queue
 
 class MinuteWorker(object):
     """A base class for workers that do some specific task in regular intervals of time"""
 
-    threaded = True # whether to perform each task as a separate thread
+    threaded = True # whether to perform the tasks in a pool of threads
+    concurrency = 20 # threads of the pool
+    task_timeout = None # seconds after which a task is abandoned, by default the interval
+    cycle_timeout = None # seconds after which tasks that haven't started are dropped and the others abandoned, by default the interval
     logger_name = 'lab_monitor.minuteworker.MinuteWorker'
     interval = 60
 
@@ -27,6 +31,24 @@ class MinuteWorker(object):
         use an empty tuple as the 2nd element."""
         return []
 
+    def cycle_done(self):
+        """Override this function to do something after all the tasks of a cycle have finished"""
+        pass
+
+    def task_key(self, task, args):
+        """Override this function if tasks of different cycles doing the same thing have different arguments.
+        A task isn't started again as long as one with the same key, abandoned in an earlier cycle, is still running."""
+        return task, args
+
+    def task_abandoned(self, task, args, running):
+        """Override this function to report a task that is still running after its timeout
+        (or at the end of the cycle) in a special way"""
+        self.log.error("Task %s%r has been running for %u seconds, abandoned", task.__name__, args, running)
+
+    def tasks_dropped(self, tasks):
+        """Override this function to report tasks that haven't started before the end of the cycle in a special way"""
+        self.log.error("%u tasks haven't started before the end of the cycle, dropped", len(tasks))
+
     def update_state(self, state):
         """Sets new worker state (starting, working, idle, stopping, off) and pushes it to a stream, if available"""
         self.state = state
@@ -37,6 +59,9 @@ class MinuteWorker(object):
         """Calls the tasks every minute"""
         self.loop = True
         self.sleeper = threading.Event()
+        if self.threaded:
+            pool = WorkerPool(self.concurrency, self.exception_handler, self.__class__.__name__)
+            timeout = self.task_timeout or self.interval
         try:
             while self.loop:
                 try:
@@ -46,18 +71,23 @@ class MinuteWorker(object):
  
                     tasks = self.tasks()
                     if self.threaded:
-                        workers = []
+                        stuck = [self.task_key(task.func, task.args) for task in pool.still_running()]
                         for task, args in tasks:
-                            worker = ExceptionThread(target=task, args=args)
-                            worker.exception_handler = self.exception_handler
-                            workers.append(worker)
-                            worker.start()
-                        for worker in workers:
-                            worker.join()
+                            if self.task_key(task, args) in stuck:
+                                self.log.warning("Skipping %s%r, it's still running since an earlier cycle", task.__name__, args)
+                        tasks = [(task, args) for task, args in tasks if self.task_key(task, args) not in stuck]
+
+                        abandoned, dropped = pool.run(tasks, timeout, t0+(self.cycle_timeout or self.interval))
+                        for task in abandoned:
+                            self.task_abandoned(task.func, task.args, time.time()-task.started)
+                        if dropped:
+                            self.tasks_dropped([(task.func, task.args) for task in dropped])
                     else:
                         for task, args in tasks:
                             task(*args)
 
+                    self.cycle_done()
+
                     t = time.time()
                     dt = t-t0
                     wait = self.interval-dt
@@ -74,6 +104,9 @@ class MinuteWorker(object):
                 
         except KeyboardInterrupt:
             self.stop()
+        finally:
+            if self.threaded:
+                pool.stop()
 
     def wait(self, secs):
         """Delays execution for given number of seconds, but breaks
@@ -113,4 +146,112 @@ class ExceptionThread(threading.Thread):
             if callable(self.exception_handler):
                 self.exception_handler(self, e)
             else:
-                raise
\ No newline at end of file
+                raise
+
+
+class Task:
+    """A task (callable with arguments) of a WorkerPool"""
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.started = None
+        self.finished = False
+        self.abandoned = False
+        self.dropped = False
+
+
+class WorkerPool:
+    """A fixed number of threads which execute tasks from a queue, reused from cycle to cycle.
+    A task that runs for too long is abandoned: nobody waits for it anymore
+    and a new thread takes the place of the one stuck with it."""
+
+    def __init__(self, size, exception_handler=None, name="Worker"):
+        self.exception_handler = exception_handler # called with the thread and the exception a task raised
+        self.name = name
+        self.queue = Queue.Queue()
+        self.changed = threading.Condition() # a task has started or finished
+        self.abandoned = [] # the ones still running
+        self.size = size
+        self.started = 0
+        self.log = logging.getLogger("lab_monitor.minuteworker.WorkerPool")
+
+        for _ in range(size):
+            self.add_thread()
+
+    def add_thread(self):
+        self.started += 1
+        thread = threading.Thread(target=self.work, name="{0}-{1}".format(self.name, self.started))
+        thread.daemon = True # a hung task mustn't keep the process alive
+        thread.start()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            with self.changed:
+                if task.dropped:
+                    continue
+                task.started = time.time()
+                self.changed.notify_all()
+            try:
+                task.func(*task.args)
+            except Exception as e:
+                if callable(self.exception_handler):
+                    self.exception_handler(threading.current_thread(), e)
+                else:
+                    self.log.exception("Exception in thread %s", threading.current_thread())
+
+            with self.changed:
+                task.finished = True
+                self.changed.notify_all()
+                if task.abandoned:
+                    self.abandoned.remove(task)
+                    return # another thread has taken its place
+
+    def run(self, tasks, timeout, deadline=None):
+        """Executes tasks, each in format (callable, args), and waits until every one has finished
+        or has been running for timeout seconds. At the deadline (time.time()), the ones that are still running
+        are abandoned and the ones that haven't started are dropped. Returns both lists (of Task)."""
+        tasks = [Task(func, args) for func, args in tasks]
+        for task in tasks:
+            self.queue.put(task)
+
+        abandoned = []
+        dropped = []
+        with self.changed:
+            pending = tasks
+            while pending:
+                now = time.time()
+                over = deadline is not None and now >= deadline
+                for task in pending:
+                    if task.started is None:
+                        if over:
+                            task.dropped = True # the thread which gets it will skip it
+                            dropped.append(task)
+                    elif not task.finished and (over or now >= task.started+timeout):
+                        task.abandoned = True
+                        abandoned.append(task)
+                        self.abandoned.append(task)
+                        self.add_thread()
+
+                pending = [task for task in pending if not (task.finished or task.abandoned or task.dropped)]
+                if pending:
+                    # with a timeout, also because waiting without one can't be interrupted
+                    deadlines = [task.started+timeout for task in pending if task.started is not None] + [now+1]
+                    if deadline is not None:
+                        deadlines.append(deadline)
+                    self.changed.wait(max(0, min(deadlines) - now))
+
+        return abandoned, dropped
+
+    def still_running(self):
+        """Returns the abandoned tasks that haven't finished yet"""
+        with self.changed:
+            return list(self.abandoned)
+
+    def stop(self):
+        """Lets the threads finish after their current tasks"""
+        for _ in range(self.size):
+            self.queue.put(None)
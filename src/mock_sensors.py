@@ -7,18 +7,25 @@ class HostUnreachableException(Exception):
 
 class SSHiLoSensors:
 
-    def __init__(self, host="pl-byd-esxi13-ilo", user="Administrator", password="ChangeMe"):
+    def __init__(self, host="pl-byd-esxi13-ilo", user="Administrator", password="ChangeMe", transport='exec', inventory=None):
         self.host = host
         self.user = user
         self.password = password
+        self.transport = transport
         self.sensors = []
         self.power_supplies = []
+        self.inventory_updater = None
 
         self.log = logging.getLogger('lab_monitor.mock_sensors.SSHiLoSensors')
         self.log.info("Initializing")
 
-        self.connect()
-        self.detect_components()
+        if inventory is not None:
+            # the real one connects on the first poll then
+            self.sensors = {'Ambient Zone': 18, 'Power Supply Zone': 40}
+            self.power_supplies = ['Power Supply 1', 'Power Supply 2']
+        else:
+            self.connect()
+            self.detect_components()
 
     def connect(self):
         self.log.info("Connecting to the iLo server at %s", self.host)
@@ -36,6 +43,17 @@ class SSHiLoSensors:
 
         self.log.info("Found %u temperature sensors and %u power supplies", len(self.sensors), len(self.power_supplies))
     
+    def snapshot(self):
+        self.log.info("Taking a snapshot")
+        time.sleep(random.uniform(0.5, 2))
+        states = dict((component, random.random()>0.4) for component in self.power_supplies)
+        return {
+            'status': random.random()>0.7,
+            'power_usage': {'present': 316, 'average': 315, 'minimum': 314, 'maximum': 330},
+            'power_units': dict((component, {'operational': state, 'health': state}) for component, state in states.iteritems()),
+            'temperature': dict((component, int(random.gauss(mean, 2))) for component, mean in self.sensors.iteritems())
+        }
+
     def server_status(self):
         self.log.info("Checking status")
         time.sleep(random.uniform(0.5, 2))
@@ -4,35 +4,64 @@ import atexit
 import logging, logging.handlers
 import os.path
 import sys
+import threading
+import time
 
 import redis
 
 from config import config
+import archive
 import construct_lab
 import database
 import minuteworker
 import notifications
 import procutils
+import pruner
 
 class Monitor(minuteworker.MinuteWorker):
 
     logger_name = 'lab_monitor.monitor.Monitor'
 
+    write_updater = None # called with a batch of readings once it's stored
+
     def start(self, lab):
         self.lab = lab
         if not self.lab.servers:
             self.log.info("Nothing to monitor")
             return
-        self.main_loop()
 
-    def check_server(self, server):
+        # readings of a whole cycle are stored at once, in the background
+        self.writer = database.WriteBehind(self.sensors_dao, on_stored=self.write_updater)
+        self.writer.start()
+        try:
+            self.main_loop()
+        finally:
+            self.writer.stop()
+
+    def check_server(self, server, batch):
         self.log.info("Checking server %s", server.addr)
         server.check_status()
         server.notify_alarms()
-        server.store_status()
+        server.store_status(batch)
 
     def tasks(self):
-        return [(self.check_server, (server,)) for server in self.lab.servers.itervalues()]
+        self.batch = self.sensors_dao.batch()
+        return [(self.check_server, (server, self.batch)) for server in self.lab.servers.itervalues()]
+
+    def task_key(self, task, args):
+        return args[0] # the server, batches differ from cycle to cycle
+
+    def task_abandoned(self, task, args, running):
+        self.log.error("Checking server %s has taken %u seconds, abandoned; it won't be checked again until it finishes", args[0].addr, running)
+
+    def tasks_dropped(self, tasks):
+        self.log.error("%u servers haven't been checked before the end of the cycle (poll_concurrency may be too low): %s",
+                       len(tasks), ', '.join(args[0].addr for task, args in tasks))
+
+    def cycle_done(self):
+        # readings of checks that have been abandoned would come too late, they are dropped
+        self.batch.close()
+        self.writer.submit(self.batch)
 
 if __name__ == '__main__':
     baselog = logging.getLogger()
@@ -75,6 +104,14 @@ if __name__ == '__main__':
 
     stateupd('starting')
 
+    # the frontend answers polls with 304 Not Modified until readings of a server change
+    def writeupd(batch):
+        try:
+            now = repr(time.time())
+            red.hmset('lab_monitor.last_write', dict((addr, now) for addr in batch.servers()))
+        except Exception:
+            baselog.exception("Cannot update the last write time")
+
     # a monitor registers its process id to redis,
     # if another instance is running right now,
     # interrupt it and wait until it finishes
@@ -106,11 +143,32 @@ if __name__ == '__main__':
         sys.exit(1)
 
     try:
-        lab = construct_lab.run(config['num_racks'], servers_dao, sensors_dao, True, monitor_opts)
+        lab = construct_lab.run(config['num_racks'], servers_dao, sensors_dao, True, monitor_opts, config.get('ilo_transport'))
     except Exception:
         baselog.exception("Cannot construct the lab")
         sys.exit(1)
     
+    if config.get('heartbeat'):
+        sensors_dao.heartbeat = 60*config['heartbeat']
+
+    archive_opts = config.get('archive') or {}
+    if archive_opts:
+        servers_dao.archive = sensors_dao.archive = archive.Archive(archive_opts['path'])
+
+    # old readings are deleted (or archived) in the background, in small chunks, so that they don't block the monitor
+    prn = pruner.Pruner(sensors_dao, config.get('retention') or {}, archive_opts.get('after'))
+    prn_thread = threading.Thread(target=prn.start, name='Pruner')
+    prn_thread.daemon = True
+    prn_thread.start()
+
     mon = Monitor()
+    if config.get('poll_concurrency'):
+        mon.concurrency = config['poll_concurrency']
+    if config.get('poll_timeout'):
+        mon.task_timeout = config['poll_timeout']
     mon.state_updater = stateupd
+    mon.write_updater = writeupd
+    mon.sensors_dao = sensors_dao
     mon.start(lab)
+
+    prn.stop()
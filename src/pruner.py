@@ -0,0 +1,34 @@
+import time
+
+import minuteworker
+
+class Pruner(minuteworker.MinuteWorker):
+    """Enforces the retention policy, deleting old readings a few seconds' worth of work at a time.
+    If an archive is configured, it then moves readings older than archive_after days there."""
+
+    logger_name = 'lab_monitor.pruner.Pruner'
+    threaded = False
+    interval = 600
+    time_budget = 20 # seconds per cycle, whatever is left will be deleted in the next one
+
+    def __init__(self, sensors_dao, retention, archive_after=None):
+        minuteworker.MinuteWorker.__init__(self)
+        self.sensors_dao = sensors_dao
+        self.retention = retention
+        self.archive_after = archive_after
+
+    def tasks(self):
+        tasks = [(self.prune, ())]
+        if self.archive_after is not None and self.sensors_dao.archive is not None:
+            tasks.append((self.archive, ()))
+        return tasks
+
+    def prune(self):
+        self.log.info("Pruning old readings")
+        if not self.sensors_dao.prune(self.retention, time.time()+self.time_budget):
+            self.log.info("Time is up, pruning will be continued in the next cycle")
+
+    def archive(self):
+        self.log.info("Archiving old readings")
+        if not self.sensors_dao.move_to_archive(self.archive_after, time.time()+self.time_budget):
+            self.log.info("Time is up, archiving will be continued in the next cycle")
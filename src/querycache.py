@@ -0,0 +1,135 @@
+"""
+A cache of SensorsDAO query results in Redis, shared by all frontend processes.
+
+Keys contain the server, the method with its arguments (for charts from rollups, the time range aligned to
+their buckets, so that charts of the same period share an entry) and the time of the last write of the server's readings,
+published by the monitor. New readings change that time, so stale entries are never read again;
+they are removed when their TTL passes or when there are too many entries.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import time
+from datetime import datetime
+
+import redis
+
+import database
+
+
+class QueryCache:
+    """Wraps a SensorsDAO, caching results of its read methods, and passes other attributes through"""
+
+    # cached methods; the generation of methods with a server is the last write of its readings,
+    # of the other ones (queries of many servers) the last write of any readings
+    methods = ['get_temperature', 'get_power_usage', 'get_power_units', 'get_status', 'get_general',
+               'get_time_bounds', 'aggregate', 'aggregate_servers', 'get_servers_time_bounds']
+
+    # methods whose range is aligned to the buckets of rollups, returning {name: [[JS time, value], ...]}
+    aligned = ['get_temperature', 'get_power_usage', 'get_power_units', 'get_status']
+
+    prefix = 'lab_monitor.cache'
+
+    def __init__(self, dao, red, last_write, ttl=600, max_entries=1000):
+        """last_write is a callable taking a server address (or None) like LabMonitor.last_write"""
+        self.dao = dao
+        self.red = red
+        self.last_write = last_write
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.log = logging.getLogger("lab_monitor.querycache.QueryCache")
+
+    def __getattr__(self, name):
+        attr = getattr(self.dao, name)
+        if name in self.methods:
+            return functools.partial(self.cached, name, attr)
+        return attr
+
+    def align(self, name, args):
+        """Extends the range of a chart from rollups to whole buckets, with the resolution the call would pick.
+        Returns the requested end, which the result has to be cut back to, or None if nothing has changed."""
+        start, end = args.get('start'), args.get('end')
+        if name not in self.aligned or start is None or end is None:
+            return None
+        resolution = args.get('resolution') or self.dao.pick_resolution(start, end)
+        if resolution == database.RAW:
+            return None # raw readings and steps of changes depend on the exact range
+        args['resolution'] = resolution
+
+        # get_rollups begins with the bucket containing the start anyway
+        start, end = database.toepoch(start), database.toepoch(end)
+        args['start'] = datetime.fromtimestamp(database.rollup_bucket(start, resolution))
+        args['end'] = datetime.fromtimestamp(database.rollup_bucket(end, resolution) + 2*resolution) # even if a day has 25 hours
+        return end
+
+    def cut(self, result, end):
+        """Drops buckets beginning after the end from a result of an aligned call"""
+        end = 1000*end # JS time
+        cut = {}
+        for name, points in result.iteritems():
+            inside = [point for point in points if point[0] <= end]
+            if inside or not points:
+                cut[name] = inside
+        return cut
+
+    def key_part(self, value):
+        """Converts an argument to a string for a key"""
+        if isinstance(value, type) and issubclass(value, database.Base):
+            return value.__tablename__
+        if isinstance(value, datetime):
+            return str(database.toepoch(value))
+        if isinstance(value, (list, tuple)):
+            return ','.join(map(self.key_part, value))
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def cached(self, name, method, *args, **kwargs):
+        args = inspect.getcallargs(method, *args, **kwargs)
+        del args['self']
+
+        generation = self.last_write(args.get('server'))
+        if generation is None:
+            # nothing would tell when the entry is stale
+            return method(**args)
+
+        end = self.align(name, args)
+        key = ':'.join([self.prefix, name, repr(generation)] +
+                       ['{0}={1}'.format(arg, self.key_part(value)) for arg, value in sorted(args.iteritems())])
+
+        try:
+            cached = self.red.get(key)
+        except redis.RedisError:
+            self.log.exception("Cannot read the cache")
+            result = method(**args)
+        else:
+            if cached is not None:
+                result = json.loads(cached)
+            else:
+                result = method(**args)
+                try:
+                    self.store(key, json.dumps(result, separators=(',', ':')))
+                except redis.RedisError:
+                    self.log.exception("Cannot write to the cache")
+
+        return self.cut(result, end) if end is not None else result
+
+    def store(self, key, value):
+        """Stores an entry, evicting the oldest ones if there are more than max_entries"""
+        index = self.prefix+':index'
+        now = time.time()
+        pipe = self.red.pipeline()
+        pipe.setex(key, self.ttl, value)
+        pipe.zadd(index, now, key)
+        pipe.zremrangebyscore(index, 0, now-self.ttl) # expired on their own
+        pipe.zcard(index)
+        size = pipe.execute()[-1]
+
+        if size > self.max_entries:
+            oldest = self.red.zrange(index, 0, size-self.max_entries-1)
+            pipe = self.red.pipeline()
+            pipe.delete(*oldest)
+            pipe.zrem(index, *oldest)
+            pipe.execute()
@@ -1,10 +1,13 @@
+import hashlib
 import logging
 import re
+import socket
 import time
-import string
 
 import paramiko
 
+import ilo_parser
+
 paramiko.Transport._preferred_ciphers = ( 'aes128-cbc', '3des-cbc' )
 paramiko.Transport._preferred_macs = ( 'hmac-md5', 'hmac-sha1' )
 paramiko.Transport._preferred_keys = ( 'ssh-rsa', 'ssh-dss' )
@@ -24,20 +27,48 @@ class HostUnreachableException(IOError):
 
 class SSHiLoSensors:
 
-    def __init__(self, host="pl-byd-esxi13-ilo", user="Administrator", password="ChangeMe"):
+    tree_level = 2 # /system1 and its children; with 'all', the whole event log would come too
+    tree_backoff = 10 # snapshots taken component by component after an incomplete output of show_tree, doubled every time
+    tree_backoff_max = 480
+
+    prompt = re.compile("</[^>]*>hpiLO->\s*$") # e.g. "</>hpiLO-> "
+    shell_timeout = 30 # seconds to wait for the prompt
+
+    sensor_name = re.compile("sensor\d+$")
+    power_supply_name = re.compile("powersupply\d+$")
+
+    def __init__(self, host="pl-byd-esxi13-ilo", user="Administrator", password="ChangeMe", transport='exec', inventory=None):
+        """Transport is either 'exec' (a new channel for every command)
+        or 'shell' (commands typed into a single interactive session, kept open).
+        Inventory is (fingerprint, sensors, power_supplies) detected before, e.g. by ServersDAO.get_inventory.
+        Those components are polled without detecting them again (and the connection is made by the first poll),
+        unless the targets of /system1 turn out to be different."""
         self.host = host
         self.user = user
         self.password = password
+        self.transport = transport
+        self.shell = None
         self.sensors = []
         self.power_supplies = []
+        self.fingerprint = None
         self.redetect = True
+        self.tree = True # whether to try show_tree (not if the iLo has refused the command)
+        self.tree_skip = 0 # snapshots to take before trying show_tree again
+        self.tree_failures = 0 # incomplete outputs of show_tree in a row
+        self.inventory_updater = None # called with (fingerprint, sensors, power_supplies) when they change
 
         self.log = logging.getLogger('lab_monitor.sensors.SSHiLoSensors')
         self.log.info("Initializing")
 
         self.ssh = ILoSSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.connect()
+
+        if inventory is not None:
+            self.fingerprint, self.sensors, self.power_supplies = inventory
+            self.redetect = False
+            self.log.info("Using %u temperature sensors and %u power supplies detected before", len(self.sensors), len(self.power_supplies))
+        else:
+            self.connect()
 
     def connect(self):
         """Establishes connection with the iLo server"""
@@ -51,35 +82,71 @@ class SSHiLoSensors:
     def disconnect(self):
         """Disconnects from the iLo server"""
         self.log.info("Disconnecting from the iLo server")
+        self.close_shell()
         self.ssh.close()
 
-    def detect_components(self):
-        """Loads all the power supplies and temperature sensors that will be monitored"""
+    def detect_components(self, system=None):
+        """Loads all the power supplies and temperature sensors that will be monitored
+        (from /system1 parsed by ilo_parser, if it's already there)"""
         self.log.info("Detecting components")
 
-        try:
-            system = self.show("/system1", False)
-        except IOError as e:
-            self.sensors = []
-            self.power_supplies = []
-            self.redetect = True
-
-        # I use list(set(...)) to remove duplicates, because they are there in the output
-        self.sensors = list(set("/system1/{0}".format(a) for a in re.findall("    (sensor\d)", system)))
-        self.power_supplies = list(set("/system1/{0}".format(a) for a in re.findall("    (powersupply\d)", system)))
+        if system is None:
+            try:
+                system = self.show_target("/system1")
+            except IOError as e:
+                self.sensors = []
+                self.power_supplies = []
+                self.redetect = True
+                return
+
+        sensors, power_supplies = self.find_children(system)
+        fingerprint = self.fingerprint_of(system)
+        changed = (fingerprint, sorted(sensors), sorted(power_supplies)) != (self.fingerprint, sorted(self.sensors), sorted(self.power_supplies))
+        self.sensors, self.power_supplies, self.fingerprint = sensors, power_supplies, fingerprint
 
         self.redetect = False
         self.log.info("Found %u temperature sensors and %u power supplies", len(self.sensors), len(self.power_supplies))
 
-    def show(self, component, autoparse=True, original=False):
-        """Executes `show component` command on the remote server.
-        If autoparse is set to True (by default it is), the output is be parsed as a dictionary.
-        If original is set to True, unparsed output is also returned as the 2nd element of a tuple"""
+        if changed and callable(self.inventory_updater):
+            try:
+                self.inventory_updater(self.fingerprint, self.sensors, self.power_supplies)
+            except Exception:
+                self.log.exception("Cannot store the detected components")
+
+    def find_children(self, system):
+        """Returns paths of temperature sensors and power supplies listed as targets of /system1"""
+        children = set(system.targets) # there are duplicates in the output
+        sensors = ["/system1/{0}".format(a) for a in children if self.sensor_name.match(a)]
+        power_supplies = ["/system1/{0}".format(a) for a in children if self.power_supply_name.match(a)]
+        return sensors, power_supplies
+
+    def fingerprint_of(self, system):
+        """Identifies the set of targets of /system1, which the monitored components are detected among"""
+        return hashlib.sha1(' '.join(sorted(set(system.targets))).encode('utf-8')).hexdigest()
+
+    def execute(self, cmd):
+        """Executes a command on the remote server and returns its output (with non-printable characters escaped)"""
+        self.log.debug("Executing `%s` on %s", cmd, self.host)
 
-        cmd = "show {0}".format(component)
+        if self.transport == 'shell':
+            output = self.shell_output(cmd)
+        else:
+            output = self.exec_output(cmd)
 
-        self.log.debug("Executing `%s` on %s", cmd, self.host)
+        try:
+            output = output.decode('utf-8')
+        except UnicodeDecodeError:
+            self.log.warning("Unicode error")
 
+        output = ilo_parser.sanitize(output)
+
+        self.log.debug("Command successful, received %u bytes of output:", len(output))
+        self.log.debug("%s", output)
+
+        return output
+
+    def exec_output(self, cmd):
+        """Executes a command on a new channel"""
         success = False
         for _ in range(3):
             try:
@@ -100,48 +167,147 @@ class SSHiLoSensors:
 
         output = stdout.read()
 
-        try:
-            output = output.decode('utf-8')
-        except UnicodeDecodeError:
-            self.log.warning("Unicode error")
+        time.sleep(0.01) # otherwise, if executed in a loop, the program throws paramiko.ssh_exception.SSHException: Unable to open channel
 
-        output = ''.join(ch if ch in string.printable else "\\0x%02X"%ord(ch) for ch in output)
+        return output
 
-        self.log.debug("Command successful, received %u bytes of output:", len(output))
-        self.log.debug("%s", output)
+    def shell_output(self, cmd):
+        """Executes a command in the interactive shell session, opening it first if needed"""
+        for _ in range(3):
+            try:
+                if self.shell is None:
+                    self.open_shell()
+                self.shell.sendall(cmd+"\r\n")
+                output = self.read_until_prompt()
+                break
+            except (socket.error, EOFError, paramiko.SSHException, AttributeError) as e:
+                # AttributeError means not even connected
+                self.log.warning("Shell session failed (%s), reopening", e)
+                self.close_shell()
+                transport = self.ssh.get_transport()
+                if transport is None or not transport.is_active():
+                    self.disconnect()
+                    self.connect()
+        else:
+            self.log.error("Reopening the shell session failed 3 times")
+            raise HostUnreachableException()
 
-        time.sleep(0.01) # otherwise, if executed in a loop, the program throws paramiko.ssh_exception.SSHException: Unable to open channel
+        # the command is echoed back before its output
+        echo, _, rest = output.partition("\n")
+        return rest if echo.strip() == cmd else output
+
+    def open_shell(self):
+        self.log.info("Opening a shell session on %s", self.host)
+        self.shell = self.ssh.invoke_shell()
+        self.shell.settimeout(self.shell_timeout)
+        self.read_until_prompt() # the welcome message
+
+    def close_shell(self):
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+
+    def read_until_prompt(self):
+        """Reads the output of the shell until the CLI prompt appears and returns it without the prompt"""
+        output = ''
+        while True:
+            match = self.prompt.search(output)
+            if match:
+                return output[:match.start()]
+            data = self.shell.recv(65536)
+            if not data:
+                raise EOFError("Shell session closed")
+            output += data
+
+    def show(self, component, autoparse=True, original=False):
+        """Executes `show component` command on the remote server.
+        If autoparse is set to True (by default it is), the output is be parsed as a dictionary.
+        If original is set to True, unparsed output is also returned as the 2nd element of a tuple"""
+
+        output = self.execute("show {0}".format(component))
 
         if autoparse:
             if original:
-                return dict(re.findall("    (\w+)=([^\r]+)", output)), output
+                return self.parse_properties(output), output
             else:
-                return dict(re.findall("    (\w+)=([^\r]+)", output))
+                return self.parse_properties(output)
         else:
             return output
 
-    def server_status(self):
-        """Checks server status"""
-        self.log.info("Checking status")
+    def parse_properties(self, output):
+        """Parses properties (key=value lines) of the output of `show`"""
+        return ilo_parser.properties(output)
+
+    def show_target(self, component):
+        """Executes `show component` and returns it parsed as an ilo_parser.Target
+        (without properties, but with the output as text, if it's not there)"""
+        output = self.execute("show {0}".format(component))
+        status, targets = ilo_parser.parse(output)
+        return targets.get(component) or ilo_parser.Target(component, output)
+
+    def show_tree(self):
+        """Shows /system1 together with its children (sensors, power supplies...) with a single command.
+        Returns {path: ilo_parser.Target} or None if the iLo doesn't support it or the output is incomplete.
+        An error status turns it off for good, an incomplete output only for some snapshots."""
+        output = self.execute("show -l {0} /system1".format(self.tree_level))
+        status, targets = ilo_parser.parse(output)
+
+        if status.get('status', '0') != '0':
+            self.log.info("%s cannot show /system1 with its children (%s), every component will be shown separately",
+                          self.host, status.get('error_tag') or status.get('status_tag'))
+            self.tree = False
+            return None
+        if '/system1' not in targets or any(child not in targets for child in sum(self.find_children(targets['/system1']), [])):
+            self.tree_failures += 1
+            self.tree_skip = min(self.tree_backoff << (self.tree_failures-1), self.tree_backoff_max)
+            self.log.warning("Incomplete output of show -l {0} /system1 from %s, the next %u snapshots will show every component separately".format(self.tree_level),
+                             self.host, self.tree_skip)
+            return None
+        self.tree_failures = 0
+        return targets
+
+    def snapshot(self):
+        """Reads server status, power usage, power supplies and temperature sensors at once,
+        with a single command if the iLo can show /system1 together with its children
+        (otherwise /system1 is shown once and then each component separately).
+        Returns a dictionary with status, power_usage, power_units and temperature."""
+        self.log.info("Taking a snapshot")
+
+        targets = None
+        if self.tree_skip > 0:
+            self.tree_skip -= 1
+        elif self.tree:
+            targets = self.show_tree()
+        if targets is None:
+            targets = {'/system1': self.show_target("/system1")}
+
+        system = targets['/system1']
+        data = {'status': self.parse_status(system.properties, system.text)}
+        if data['status'] and (self.redetect or self.fingerprint_of(system) != self.fingerprint):
+            # there's no need for another command, components are listed in /system1
+            self.detect_components(system)
+        data['power_usage'] = self.parse_power_use(system.properties, system.text)
+
+        data['power_units'] = {}
+        for component in self.power_supplies:
+            target = targets.get(component) or self.show_target(component)
+            data['power_units'].update(self.parse_power_unit(component, target.properties, target.text))
 
-        response, original = self.show("/system1", original=True)
+        data['temperature'] = {}
+        for component in self.sensors:
+            target = targets.get(component) or self.show_target(component)
+            data['temperature'].update(self.parse_sensor(component, target.properties, target.text))
+
+        return data
+
+    def parse_status(self, response, original):
         try:
-            enabled = response['enabledstate']=="enabled"
+            return response['enabledstate']=="enabled"
         except KeyError:
             self.log.warning("Cannot find 'enabledstate' in response from %s, returning False. Original output:\n%s", self.host, original)
             return False
 
-        if enabled and self.redetect:
-            self.detect_components()
-
-        return enabled
-
-    def power_use(self):
-        """Returns power usage"""
-        self.log.info("Checking power usage")
-
-        response, original = self.show("/system1", original=True)
-
+    def parse_power_use(self, response, original):
         data = {}
         ilo_keys = [
             ('present', 'oemhp_PresentPower'),
@@ -161,6 +327,47 @@ class SSHiLoSensors:
 
         return data
 
+    def parse_power_unit(self, component, response, original):
+        try:
+            return {response['ElementName']: {
+                'operational': response.get('OperationalStatus')=='Ok',
+                'health': response.get('HealthState')=='Ok'
+            }}
+        except KeyError:
+            self.log.warning("Cannot parse data for %s at %s. Original output:\n%s", component, self.host, original)
+            return {}
+
+    def parse_sensor(self, component, response, original):
+        try:
+            if response['CurrentReading'] != 'N/A':
+                return {response['ElementName']: int(response['CurrentReading'])}
+            else:
+                self.log.debug("Reading for %s is N/A", component)
+        except KeyError:
+            self.log.warning("Cannot parse data for %s at %s. Original output:\n%s", component, self.host, original)
+        except ValueError:
+            self.log.warning("Cannot parse data for %s at %s (%s)", component, self.host, response['CurrentReading'])
+        return {}
+
+    def server_status(self):
+        """Checks server status"""
+        self.log.info("Checking status")
+
+        response, original = self.show("/system1", original=True)
+        enabled = self.parse_status(response, original)
+
+        if enabled and self.redetect:
+            self.detect_components()
+
+        return enabled
+
+    def power_use(self):
+        """Returns power usage"""
+        self.log.info("Checking power usage")
+
+        response, original = self.show("/system1", original=True)
+        return self.parse_power_use(response, original)
+
     def power_units(self):
         """ Returns health states and operational statuses of all power supplies"""
         self.log.info("Checking power units")
@@ -169,13 +376,7 @@ class SSHiLoSensors:
 
         for component in self.power_supplies:
             response, original = self.show(component, original=True)
-            try:
-                data[response['ElementName']] = {
-                    'operational': response.get('OperationalStatus')=='Ok',
-                    'health': response.get('HealthState')=='Ok'
-                }
-            except KeyError:
-                self.log.warning("Cannot parse data for %s at %s. Original output:\n%s", component, self.host, original)
+            data.update(self.parse_power_unit(component, response, original))
 
         return data
 
@@ -186,14 +387,6 @@ class SSHiLoSensors:
 
         for component in self.sensors:
             response, original = self.show(component, original=True)
-            try:
-                if response['CurrentReading'] != 'N/A':
-                    data[response['ElementName']] = int(response['CurrentReading'])
-                else:
-                    self.log.debug("Reading for %s is N/A", component)
-            except KeyError:
-                self.log.warning("Cannot parse data for %s at %s. Original output:\n", component, self.host, original)
-            except ValueError:
-                self.log.warning("Cannot parse data for %s at %s (%s)", component, self.host, response['CurrentReading'])
+            data.update(self.parse_sensor(component, response, original))
 
         return data
@@ -211,10 +211,11 @@ class Server:
 
     def check_status(self):
         try:
-            self.server_status = self.sensors.server_status()
-            self.power_usage = self.sensors.power_use()
-            self.power_units = self.sensors.power_units()
-            self.temperature = self.sensors.temp_sensors()
+            snapshot = self.sensors.snapshot()
+            self.server_status = snapshot['status']
+            self.power_usage = snapshot['power_usage']
+            self.power_units = snapshot['power_units']
+            self.temperature = snapshot['temperature']
 
         except sensors_mod.HostUnreachableException:
             # it has already been logged
@@ -223,24 +224,27 @@ class Server:
         if self.server_status:
             self.last_reading = datetime.datetime.now()
 
-    def store_status(self):
-        self.sensors_dao.store_server_status(self.addr, self.server_status)
+    def store_status(self, batch=None):
+        # a ReadingsBatch has the same interface as SensorsDAO, but stores everything at once later
+        dao = batch if batch is not None else self.sensors_dao
+
+        dao.store_server_status(self.addr, self.server_status)
 
         for unit, state in self.power_units.iteritems():
             if state['health'] is None and state['operational'] is None:
                 # SSHiLoSensors would return bool. If those values are None,
                 # it means data is not available, so we shouldn't store it
                 continue
-            self.sensors_dao.store_power_unit(self.addr, unit, **state)
+            dao.store_power_unit(self.addr, unit, **state)
 
         if self.server_status:
             # if server is down, you won't find anything interesting here
             if all(k in self.power_usage and self.power_usage[k] is not None
                      for k in ['present', 'average', 'minimum', 'maximum']):
-                self.sensors_dao.store_power_usage(self.addr, **self.power_usage)
+                dao.store_power_usage(self.addr, **self.power_usage)
 
             for sensor, reading in self.temperature.iteritems():
-                self.sensors_dao.store_temperature(self.addr, sensor, reading)
+                dao.store_temperature(self.addr, sensor, reading)
 
     def shutdown(self, timeout=None):
         self.hypervisor.shutdown(timeout)
@@ -155,6 +155,29 @@ function rackDiagram(ctx, map, url_template, lab, racks) {
     });
 }
 
+function decodeColumnar(r)
+{
+    // turns a ?format=columnar response back into {name: [[timestamp, value], ...]}
+    var arrays = [];
+    for(var i=0; i<r.timestamps.length; i++)
+    {
+        var timestamps = r.timestamps[i].slice();
+        if(r.delta)
+            for(var j=1; j<timestamps.length; j++)
+                timestamps[j] += timestamps[j-1];
+        arrays.push(timestamps);
+    }
+
+    var data = {};
+    $.each(r.data, function(name, series){
+        var timestamps = arrays[series.timestamps];
+        data[name] = [];
+        for(var i=0; i<timestamps.length; i++)
+            data[name].push([timestamps[i], series.values[i]]);
+    });
+    return data;
+}
+
 function drawChart(url, area, params){
 
     Highcharts.setOptions({
@@ -163,6 +186,10 @@ function drawChart(url, area, params){
         }
     });
 
+    // there's no point in loading more points than the chart has pixels
+    // and the columnar format is a few times smaller
+    params = $.extend({points: $(area).width(), format: 'columnar', delta: 1}, params);
+
     var series_data = [];
     $.getJSON(url, params, function(r){
         if(!r.bounds)
@@ -171,14 +198,22 @@ function drawChart(url, area, params){
             return;
         }
 
+        r.data = decodeColumnar(r);
+        var last_point = 0;
         $.each(r.data, function(name, data){
             series_data.push({
                 'name': name,
                 'data': data,
                 'animation': false
             });
+            if(data.length)
+                last_point = Math.max(last_point, data[data.length-1][0]);
         });
 
+        // charts showing the latest data can be updated with new points only (see updateChart)
+        $(area).data('live', typeof params.start=='undefined' && typeof params.end=='undefined');
+        $(area).data('last-point', last_point);
+
         if(!series_data.length)
         {
             // If there were no data at all, the !r.bounds condition would have already returned.
@@ -275,6 +310,42 @@ function drawChart(url, area, params){
     })
 }
 
+function updateChart(url, area)
+{
+    // appends readings newer than the last point to a chart showing the latest data, otherwise reloads it
+    var chart = $(area).highcharts();
+    if(typeof chart=='undefined' || !$(area).data('live'))
+        return drawChart(url, area);
+
+    $.getJSON(url, {since: $(area).data('last-point'), format: 'columnar', delta: 1}, function(r){
+        if(!r.bounds)
+            return;
+
+        var series = {};
+        $.each(chart.series, function(i, s){
+            series[s.name] = s;
+        });
+
+        $.each(decodeColumnar(r), function(name, data){
+            if(!data.length)
+                return true;
+            if(typeof series[name]=='undefined')
+                chart.addSeries({'name': name, 'data': data, 'animation': false}, false);
+            else
+                $.each(data, function(i, point){
+                    series[name].addPoint(point, false);
+                });
+            $(area).data('last-point', Math.max($(area).data('last-point'), data[data.length-1][0]));
+        });
+
+        if(typeof series['Navigator']!='undefined')
+            series['Navigator'].addPoint([r.bounds[1], null], false);
+        chart.redraw();
+    }).fail(function(){
+        drawChart(url, area);
+    });
+}
+
 function modalConfirm(confirm_text, ok_button)
 {
     var modal = $('<div class="modal fade">')
@@ -28,6 +28,7 @@ try:
     import paramiko
     import redis
     import xmpp
+    import numpy
 except ImportError as e:
     venv = "" if hasattr(sys, 'real_prefix') else "\nHint: you are not running inside a virtualenv"
     error("{0}. Did you run `pip install -r requirements.txt`?{1}".format(e, venv))
@@ -81,6 +82,53 @@ for s in config['temperature']:
         error("Temperature critical level cannot be less than warning level")
 success("Temperature alarms are configured properly")
 
+retention = config.get('retention') or {}
+if type(retention) is not dict:
+    error("Configuration key 'retention' must be of type dict")
+for key, days in retention.iteritems():
+    if key not in ('raw', 'hour', 'day'):
+        error("Unknown retention key '{0}' (should be raw, hour or day)".format(key))
+    if days is not None and (type(days) is not int or days <= 0):
+        error("Retention of {0} data must be a positive number of days".format(key))
+success("Retention policy is configured properly")
+
+heartbeat = config.get('heartbeat')
+if heartbeat is not None and (type(heartbeat) is not int or heartbeat <= 0):
+    error("Heartbeat must be a positive number of minutes")
+
+archive = config.get('archive')
+if archive is not None:
+    if type(archive) is not dict or 'path' not in archive or 'after' not in archive:
+        error("Configuration key 'archive' must contain 'path' and 'after'")
+    if not os.path.isdir(archive['path']):
+        error("Specified archive path is not a valid directory")
+    if type(archive['after']) is not int or archive['after'] <= 0:
+        error("Readings must be archived after a positive number of days")
+    if retention.get('raw') is not None and archive['after'] >= retention['raw']:
+        error("Readings must be archived before they are pruned (archive 'after' is not less than raw retention)")
+    success("Archive is configured properly")
+
+ilo_transport = config.get('ilo_transport') or {}
+if type(ilo_transport) is not dict:
+    error("Configuration key 'ilo_transport' must be of type dict")
+transports = [ilo_transport.get('default', 'exec')] + (ilo_transport.get('servers') or {}).values()
+for transport in transports:
+    if transport not in ('exec', 'shell'):
+        error("Unknown iLo transport '{0}' (should be exec or shell)".format(transport))
+
+for key in ['poll_concurrency', 'poll_timeout']:
+    value = config.get(key)
+    if value is not None and (type(value) is not int or value <= 0):
+        error("Configuration key '{0}' must be a positive number".format(key))
+
+cache = config.get('cache')
+if cache is not None:
+    if type(cache) is not dict or set(cache) - set(['ttl', 'max_entries']):
+        error("Configuration key 'cache' can only contain 'ttl' and 'max_entries'")
+    for key, value in cache.iteritems():
+        if type(value) is not int or value <= 0:
+            error("Cache {0} must be a positive number".format(key))
+    success("Query cache is configured properly")
 
 try:
     path = config['logging_dir']